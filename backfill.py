@@ -0,0 +1,174 @@
+import argparse
+import os
+import time
+from datetime import datetime
+from config import BACKFILL_JOURNAL_PATH
+from dropship_db import ExampleDb
+from ftp import FTPManager
+from invalid_file_checker import InvalidFileChecker
+from progress import set_quiet
+from run_journal import RunJournal
+from xlsx_parser import XlsxParser
+
+# Files already uploaded once are expected in an archive, so the file level duplicate
+# rule is skipped and duplicates are suppressed per purchase order instead
+EXCLUDED_RULES = ("is_not_duplicate",)
+
+
+def _list_archive(ftp, ftp_folder_name, local_path):
+    """Returns the (file name, modified datetime) of every file in the archive"""
+
+    if local_path:
+        return [
+            (entry.name, datetime.fromtimestamp(entry.stat().st_mtime))
+            for entry in os.scandir(local_path)
+            if entry.is_file()
+        ]
+
+    remote_folder = f"dropshipper_logs/order_logs/{ftp_folder_name}"
+    return [(name, modified) for name, size, modified in ftp.list_files(remote_folder)]
+
+
+def _store_batch(d_db, parser, dropshipper_data, dropshipper_id, valid_files, context):
+    """Parses a batch of valid files and stores the orders that are not in the database yet"""
+
+    po_objs, unparsed_skus = parser.file_parser({dropshipper_id: valid_files})
+    po_objs, rejected_skus = parser.check_allowed_skus(po_objs, dropshipper_data)
+    unable_to_ship, shipable_orders_objs = parser.check_shipping_states(
+        po_objs, context["excluded_shipping_states"], context["international_accounts"]
+    )
+
+    existing = d_db.get_existing_purchase_orders(list(shipable_orders_objs))
+    new_orders = {
+        po_number: po_obj
+        for po_number, po_obj in shipable_orders_objs.items()
+        if po_number not in existing
+    }
+
+    if new_orders:
+        d_db.store_purchase_orders(new_orders)
+
+    return {
+        "stored": len(new_orders),
+        "duplicates": len(existing),
+        "unable_to_ship": len(unable_to_ship),
+        "rejected_skus": sum(len(skus) for skus in rejected_skus.values()),
+    }
+
+
+def backfill(ftp_folder_name, start, end, local_path=None, batch_size=200):
+    """Re-ingests the archived order files of a dropshipper modified between start and end"""
+
+    d_db = ExampleDb()
+    ftp = FTPManager()
+    journal = RunJournal(BACKFILL_JOURNAL_PATH)
+
+    try:
+        dropshipper_data = d_db.load_dropship_data()
+        dropshipper = dropshipper_data[ftp_folder_name]
+        context = {
+            "international_accounts": d_db.get_international_accounts(),
+            "excluded_shipping_states": d_db.load_excluded_shipping_states(),
+        }
+
+        parser = XlsxParser(dropshipper_data, d_db)
+        checker = InvalidFileChecker(d_db, parser)
+
+        # Files stored or rejected by an earlier backfill are skipped
+        checkpoints = journal.stages(ftp_folder_name)
+        files = sorted(
+            (modified, name)
+            for name, modified in _list_archive(ftp, ftp_folder_name, local_path)
+            if start <= modified.date() <= end
+            and not (
+                name in checkpoints
+                and (checkpoints[name][0] == "stored" or checkpoints[name][1])
+            )
+        )
+        file_names = [name for _, name in files]
+        print(f"Backfilling {len(file_names)} files for {ftp_folder_name}")
+
+        totals = {"stored": 0, "duplicates": 0, "unable_to_ship": 0, "rejected_skus": 0}
+        started = time.perf_counter()
+
+        for i in range(0, len(file_names), batch_size):
+            batch = file_names[i : i + batch_size]
+
+            if local_path:
+                paths = [os.path.join(local_path, name) for name in batch]
+            else:
+                paths = ftp.download_batch(
+                    f"dropshipper_logs/order_logs/{ftp_folder_name}",
+                    batch,
+                    os.path.join("tmp", "backfill", ftp_folder_name),
+                )
+
+            valid_files, invalid_files = checker.validate_paths(
+                paths,
+                dropshipper["headers"],
+                desc=f"Validating batch {i // batch_size + 1}",
+                exclude=EXCLUDED_RULES,
+            )
+            journal.record_invalid(ftp_folder_name, invalid_files)
+
+            if valid_files:
+                counts = _store_batch(
+                    d_db,
+                    parser,
+                    dropshipper_data,
+                    dropshipper["id"],
+                    valid_files,
+                    context,
+                )
+                for key, value in counts.items():
+                    totals[key] += value
+
+            # The checkpoint is written only once the batch is committed
+            journal.record(ftp_folder_name, valid_files, "stored")
+
+            # Downloaded copies are removed so disk use stays bounded
+            if not local_path:
+                for path in paths:
+                    os.remove(path)
+
+            done = min(i + batch_size, len(file_names))
+            elapsed = time.perf_counter() - started
+            print(
+                f"{done}/{len(file_names)} files, {totals['stored']} orders stored, "
+                f"{totals['duplicates']} duplicates skipped, "
+                f"{done / elapsed if elapsed else 0:.1f} files/s"
+            )
+
+        print(f"Backfill of {ftp_folder_name} finished: {totals}")
+        return totals
+
+    finally:
+        journal.close()
+        d_db.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Re-ingest archived order files of a dropshipper"
+    )
+    arg_parser.add_argument("folder", help="FTP folder name of the dropshipper")
+    arg_parser.add_argument("--start", required=True, help="First date, YYYY-MM-DD")
+    arg_parser.add_argument("--end", required=True, help="Last date, YYYY-MM-DD")
+    arg_parser.add_argument(
+        "--local-path",
+        help="Local copy of the archive, the FTP order_logs folder is used otherwise",
+    )
+    arg_parser.add_argument("--batch-size", type=int, default=200)
+    arg_parser.add_argument("--quiet", action="store_true")
+    args = arg_parser.parse_args()
+
+    if args.quiet:
+        set_quiet(True)
+
+    backfill(
+        args.folder,
+        datetime.strptime(args.start, "%Y-%m-%d").date(),
+        datetime.strptime(args.end, "%Y-%m-%d").date(),
+        args.local_path,
+        args.batch_size,
+    )
@@ -0,0 +1,145 @@
+"""Compares the peak memory of assembling many parsed files column by column with the previous concat path.
+
+Every path runs in its own process, so the reported peak RSS is its own.
+
+    python benchmarks/file_parser_memory.py --files 200 --rows 5000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Already standardized names, so the benchmark does not need the dropshipper data
+HEADER = [
+    "purchase_order_number",
+    "customer_first_name",
+    "customer_last_name",
+    "address_1",
+    "address_2",
+    "city",
+    "state",
+    "zip",
+    "country",
+    "phone",
+    "sku",
+    "quantity",
+]
+
+
+def write_files(folder, files, rows):
+    cities = ["Springfield", "Shelbyville", "Ogdenville", "North Haverbrook"]
+    for file_number in range(files):
+        with open(os.path.join(folder, f"orders_{file_number}.csv"), "w") as f:
+            f.write(",".join(HEADER) + "\n")
+            for i in range(rows):
+                f.write(
+                    f"PO{file_number}-{i // 3},Jane,Doe,{i} Main St,,"
+                    f"{cities[i % len(cities)]},IL,62701,US,555-0100,"
+                    f"SKU-{i % 500},{i % 5 + 1}\n"
+                )
+            # Blank lines like the ones some dropshippers leave at the end
+            f.write("," * (len(HEADER) - 1) + "\n")
+
+
+def peak_rss_mb():
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def concat_frames(frames):
+    """The assembly file_parser used before the frames were built column by column"""
+
+    import numpy as np
+    import pandas as pd
+
+    dfs = []
+    for dropshipper_id, df in frames:
+        df = df.fillna("")
+        df.loc[:, "dropshipper_id"] = np.nan
+        df.loc[df.notna().any(axis=1), "dropshipper_id"] = dropshipper_id
+        dfs.append(df)
+
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.dropna(how="all").fillna("")
+    df["dropshipper_id"] = df["dropshipper_id"].astype(int)
+    return df
+
+
+def run_path(path, folder):
+    """Reads and assembles every file once and prints the timing and memory as JSON"""
+
+    import pandas as pd
+    from xlsx_parser import XlsxParser
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+
+    frames = []
+    for file_number, file_name in enumerate(sorted(os.listdir(folder))):
+        df = pd.read_csv(os.path.join(folder, file_name), dtype=str)
+        # A few dropshippers share the run, like in production
+        frames.append((file_number % 10 + 1, df.dropna(how="all")))
+
+    if path == "columns":
+        # The assembly does not use the database backed state of the parser
+        df = XlsxParser.__new__(XlsxParser)._assemble_frames(frames)
+    else:
+        df = concat_frames(frames)
+    del frames
+
+    print(
+        json.dumps(
+            {
+                "path": path,
+                "rows": len(df),
+                "frame_mb": df.memory_usage(deep=True).sum() / 1024**2,
+                "seconds": time.perf_counter() - start,
+                "peak_rss_mb": peak_rss_mb(),
+                "peak_rss_growth_mb": peak_rss_mb() - baseline,
+            }
+        )
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--files", type=int, default=200)
+    arg_parser.add_argument("--rows", type=int, default=5000)
+    arg_parser.add_argument("--run", nargs=2, metavar=("PATH", "FOLDER"))
+    args = arg_parser.parse_args()
+
+    if args.run:
+        run_path(*args.run)
+        return
+
+    with tempfile.TemporaryDirectory() as folder:
+        write_files(folder, args.files, args.rows)
+        print(f"Files: {args.files} of {args.rows} rows")
+
+        for path in ["columns", "concat"]:
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", path, folder],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{path:>7}: {result['seconds']:.2f}s, "
+                f"frame {result['frame_mb']:.0f} MB, "
+                f"peak RSS {result['peak_rss_mb']:.0f} MB "
+                f"(+{result['peak_rss_growth_mb']:.0f} MB while parsing)"
+            )
+
+
+if __name__ == "__main__":
+    main()
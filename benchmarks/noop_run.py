@@ -0,0 +1,141 @@
+"""Compares the run time of a run without pending folders with lazy and with eager imports.
+
+Every run imports main in its own process, so the imports are paid each time.
+The database, FTP server and leases are replaced by stand-ins with no waiting files.
+
+    python benchmarks/noop_run.py --runs 5
+"""
+
+import argparse
+import importlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+class StandInPool:
+    size = 4
+
+
+class StandInDb:
+    """Answers the queries of a run with a few dropshippers and no new orders"""
+
+    def __init__(self, dropshippers=10):
+        self.pool = StandInPool()
+        self.dropshippers = {
+            i: {"id": i, "name": f"Dropshipper {i}", "ftp_folder_name": f"folder_{i}"}
+            for i in range(1, dropshippers + 1)
+        }
+
+    def load_dropship_data(self):
+        return self.dropshippers
+
+    def get_international_accounts(self):
+        return []
+
+    def load_excluded_shipping_states(self):
+        return {}
+
+    def get_header_maps(self):
+        return {}
+
+    def get_country_and_states(self):
+        return {}
+
+    def register_files(self, files):
+        return []
+
+    def close(self):
+        pass
+
+
+class StandInLeases:
+    def __init__(self, d_db):
+        pass
+
+    def holds(self, folder_name):
+        return True
+
+    def close(self):
+        pass
+
+
+def run_once(imports):
+    """Imports main and runs it once, printing the timings as JSON"""
+
+    start = time.perf_counter()
+
+    if imports == "eager":
+        import lazy_imports
+
+        lazy_imports.lazy_import = importlib.import_module
+
+    import main
+    from ftp import FTPManager
+
+    imported = time.perf_counter()
+
+    class IdleFtp(FTPManager):
+        def list_files(self, remote_folder):
+            return []
+
+    main.ExampleDb = StandInDb
+    main.FTPManager = IdleFtp
+    main.FolderLeases = StandInLeases
+    main.main(quiet=True)
+
+    finished = time.perf_counter()
+    print(
+        json.dumps(
+            {
+                "imports": imports,
+                "import_seconds": imported - start,
+                "total_seconds": finished - start,
+                # Touching an attribute would load a lazy module, its type tells instead
+                "pandas_loaded": type(sys.modules.get("pandas")) is types.ModuleType,
+            }
+        )
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--run", choices=["lazy", "eager"])
+    args = arg_parser.parse_args()
+
+    if args.run:
+        run_once(args.run)
+        return
+
+    for imports in ["lazy", "eager"]:
+        results = []
+        for _ in range(args.runs):
+            # The journal, spool and schedule state paths are relative to the working directory
+            with tempfile.TemporaryDirectory() as work_dir:
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--run", imports],
+                    cwd=work_dir,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+        print(
+            f"{imports:>5}: import main {statistics.median(r['import_seconds'] for r in results):.3f}s, "
+            f"import and run {statistics.median(r['total_seconds'] for r in results):.3f}s "
+            f"(median of {args.runs}), pandas loaded: {results[-1]['pandas_loaded']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Compares the chunked xlsx reader of XlsxParser with pandas' default Excel reader.
+
+Every reader runs in its own process, so the reported peak RSS is its own.
+
+    python benchmarks/xlsx_reader.py --rows 200000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEADER = [
+    "PO Number",
+    "First Name",
+    "Last Name",
+    "Address 1",
+    "Address 2",
+    "City",
+    "State",
+    "Zip",
+    "Country",
+    "Phone",
+    "SKU",
+    "Quantity",
+]
+
+
+def write_workbook(path, rows):
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(HEADER)
+    for i in range(rows):
+        sheet.append(
+            [
+                f"PO{i // 3}",
+                "Jane",
+                "Doe",
+                f"{i} Main St",
+                "",
+                "Springfield",
+                "IL",
+                62701,
+                "US",
+                "555-0100",
+                f"SKU-{i % 500}",
+                i % 5 + 1,
+            ]
+        )
+    workbook.save(path)
+
+
+def peak_rss_mb():
+    import resource
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_reader(reader, path):
+    """Reads the workbook once and prints the timing and memory as JSON"""
+
+    import pandas as pd
+    from xlsx_parser import XlsxParser
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+
+    if reader == "chunked":
+        # The reader does not use the database backed state of the parser
+        df = XlsxParser.__new__(XlsxParser)._read_xlsx(path)
+    else:
+        df = pd.read_excel(path, dtype=str)
+
+    print(
+        json.dumps(
+            {
+                "reader": reader,
+                "rows": len(df),
+                "seconds": time.perf_counter() - start,
+                "peak_rss_mb": peak_rss_mb(),
+                "peak_rss_growth_mb": peak_rss_mb() - baseline,
+            }
+        )
+    )
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    arg_parser.add_argument("--rows", type=int, default=100000)
+    arg_parser.add_argument("--run", nargs=2, metavar=("READER", "PATH"))
+    args = arg_parser.parse_args()
+
+    if args.run:
+        run_reader(*args.run)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "orders.xlsx")
+        write_workbook(path, args.rows)
+        print(f"Workbook: {args.rows} rows, {os.path.getsize(path) / 1024**2:.1f} MB")
+
+        for reader in ["chunked", "pandas"]:
+            output = subprocess.run(
+                [sys.executable, __file__, "--run", reader, path],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{reader:>9}: {result['seconds']:.2f}s, "
+                f"peak RSS {result['peak_rss_mb']:.0f} MB "
+                f"(+{result['peak_rss_growth_mb']:.0f} MB while reading)"
+            )
+
+
+if __name__ == "__main__":
+    main()
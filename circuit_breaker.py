@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+import time
+from config import ftp_circuit_breaker
+
+
+class CircuitBreaker:
+    """Per-folder circuit breakers persisted between runs.
+
+    A folder failing failure_threshold times in a row is skipped until the cool down
+    passes. It is then tried again, and one more failure skips it for another cool down.
+    """
+
+    def __init__(
+        self,
+        failure_threshold=ftp_circuit_breaker["failure_threshold"],
+        cooldown_minutes=ftp_circuit_breaker["cooldown_minutes"],
+        state_path=ftp_circuit_breaker["state_path"],
+    ):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_minutes * 60
+        self.state_path = state_path
+        self.skipped = {}
+        self._lock = threading.Lock()
+        self._state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def allow(self, folder):
+        """Returns False, and records the folder as skipped, while its breaker is open"""
+
+        with self._lock:
+            breaker = self._state.get(folder)
+            if (
+                breaker
+                and breaker["failures"] >= self.failure_threshold
+                and time.time() - breaker["opened_at"] < self.cooldown_seconds
+            ):
+                self.skipped[folder] = breaker["last_error"]
+                return False
+            return True
+
+    def record_success(self, folder):
+        with self._lock:
+            self._state.pop(folder, None)
+
+    def record_failure(self, folder, error):
+        with self._lock:
+            breaker = self._state.setdefault(
+                folder, {"failures": 0, "opened_at": 0, "last_error": None}
+            )
+            breaker["failures"] += 1
+            breaker["last_error"] = str(error)
+            if breaker["failures"] >= self.failure_threshold:
+                breaker["opened_at"] = time.time()
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with self._lock:
+                with open(tmp_path, "w") as file:
+                    json.dump(self._state, file, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+        except Exception as e:
+            print(f"Error saving the circuit breakers: {e}")
@@ -0,0 +1,80 @@
+import bz2
+import gzip
+import lzma
+import os
+import zipfile
+from contextlib import contextmanager
+
+# Single file compressors, the inner name is the file name without the extension
+STREAM_OPENERS = {
+    ".gz": gzip.open,
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+}
+
+
+def is_compressed(file_path):
+    return file_path.lower().endswith((".zip", *STREAM_OPENERS))
+
+
+def _zip_member(archive):
+    """Returns the single file inside a zip archive"""
+
+    members = [info for info in archive.infolist() if not info.is_dir()]
+    if len(members) != 1:
+        raise ValueError(
+            f"Zip archives must hold exactly one file, found {len(members)}"
+        )
+    return members[0]
+
+
+def inner_name(file_path):
+    """Returns the name of the file inside an archive, or the file name itself"""
+
+    file_name = os.path.basename(file_path.replace("\\", "/"))
+    lower_name = file_name.lower()
+
+    if lower_name.endswith(".zip"):
+        with zipfile.ZipFile(file_path) as archive:
+            return os.path.basename(_zip_member(archive).filename)
+
+    for extension in STREAM_OPENERS:
+        if lower_name.endswith(extension):
+            return file_name[: -len(extension)]
+
+    return file_name
+
+
+@contextmanager
+def open_order_file(file_path):
+    """Opens an order file as a binary stream, decompressing it on the fly"""
+
+    lower_path = file_path.lower()
+
+    if lower_path.endswith(".zip"):
+        with zipfile.ZipFile(file_path) as archive:
+            with archive.open(_zip_member(archive)) as stream:
+                yield stream
+        return
+
+    for extension, opener in STREAM_OPENERS.items():
+        if lower_path.endswith(extension):
+            with opener(file_path, "rb") as stream:
+                yield stream
+            return
+
+    with open(file_path, "rb") as stream:
+        yield stream
+
+
+def has_content(file_path):
+    """Checks that a file, or the file inside an archive, is not empty"""
+
+    if os.path.getsize(file_path) == 0:
+        return False
+
+    if not is_compressed(file_path):
+        return True
+
+    with open_order_file(file_path) as stream:
+        return bool(stream.read(1))
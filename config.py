@@ -6,6 +6,7 @@ db_config = {
         "password": "password",
         "driver": "{ODBC Driver 17 for SQL Server}",
         "port": 1433,  # Default port
+        "pool_size": 4,  # Connections shared by the concurrent dropshipper workers
     },
 }
 
@@ -26,6 +27,66 @@ ftp_server = {
     "password": "password",
 }
 
+# Retries of a failed FTP transfer, resumed where it stopped
+ftp_transfer = {
+    "max_attempts": 5,
+    "backoff_seconds": 1,  # Doubled on every retry
+    "max_backoff_seconds": 30,
+    # Seconds before a hung FTP operation fails
+    "connect_timeout": 30,
+    "command_timeout": 60,
+    "transfer_timeout": 120,  # Without any data received
+}
+
+# Folders failing failure_threshold runs in a row are skipped until the cool down passes
+ftp_circuit_breaker = {
+    "failure_threshold": 3,
+    "cooldown_minutes": 30,
+    "state_path": "cache/ftp_circuit_breakers.json",
+}
+
+# Leases on the dropshipper folders, so several workers can run without processing a folder twice.
+# A worker that stops renewing its leases loses them once they expire
+folder_leases = {
+    "ttl_seconds": 300,
+    "heartbeat_seconds": 60,
+}
+
+# Local folder the FTP files are downloaded to. Files the journal still needs are never
+# evicted, the rest is removed once older than max_age_days or, oldest first, while the
+# folder is above max_bytes
+local_spool = {
+    "root": "tmp",
+    "max_bytes": 5 * 1024**3,
+    "max_age_days": 14,
+}
+
+# Order in which the dropshipper folders are processed. Folders closest to missing their SLA,
+# measured from their oldest waiting file, go first. Folders not started within the run
+# budget are deferred to the next run and go ahead of the others then
+schedule = {
+    "run_budget_seconds": 30 * 60,
+    "default_sla_minutes": 60,
+    "sla_minutes": {},  # Per FTP folder name
+    "priorities": {},  # Per FTP folder name, higher goes first at equal SLA slack
+    "state_path": "cache/schedule_state.json",
+}
+
+# Local journal used to resume interrupted runs
+JOURNAL_PATH = "run_journal.db"
+
+# Checkpoints of the historical backfill, kept apart from the regular runs
+BACKFILL_JOURNAL_PATH = "backfill_journal.db"
+
+# Parquet copies of the normalized orders, used to replay them into the database
+SPOOL_DIR = "order_spool"
+
+# Allowed SKU indexes kept between runs, reloaded when a dropshipper's catalog changes
+SKU_INDEX_CACHE = "cache/allowed_skus.pkl"
+
+# Per-run CPU and memory profiles written when profiling is enabled
+PROFILE_DIR = "profiles"
+
 SENDER_EMAIL = "sender_email@domain.com"
 SENDER_PASSWORD = "sender_password"
 RECIPIENT_EMAILS = [
@@ -0,0 +1,152 @@
+import pyodbc
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PooledConnection:
+    """A pyodbc connection and the single cursor its statements run on"""
+
+    def __init__(self, connection_string):
+        self.conn = pyodbc.connect(connection_string)
+        self.last_used = time.monotonic()
+        # Without MARS a second cursor can't run a statement while another one has
+        # unread results, so every statement runs on one cursor. Executing on it
+        # discards the unread results, and pyodbc still skips re-preparing a
+        # statement run twice in a row
+        self.cursor = self.conn.cursor()
+
+    def execute(self, sql, *params):
+        self.cursor.execute(sql, *params)
+        return self.cursor
+
+    def executemany(self, sql, params, fast=False):
+        self.cursor.fast_executemany = fast
+        self.cursor.executemany(sql, params)
+        return self.cursor
+
+    def is_healthy(self):
+        try:
+            self.cursor.execute("SELECT 1").fetchone()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+
+class ConnectionPool:
+    """A bounded pool of database connections with checkout, return and health checks"""
+
+    def __init__(
+        self,
+        connection_string,
+        size=4,
+        health_check_interval=30,
+        checkout_timeout=60,
+    ):
+        self.connection_string = connection_string
+        self.size = size
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        # LIFO so the most recently used, and most likely alive, connection is reused.
+        # The condition wakes the threads waiting for a connection when one is returned
+        # or discarded, so a discarded connection is replaced right away
+        self._idle = []
+        self._created = 0
+        self._available = threading.Condition()
+
+    def _create(self):
+        try:
+            return PooledConnection(self.connection_string)
+        except pyodbc.Error:
+            with self._available:
+                self._created -= 1
+                self._available.notify()
+            raise
+
+    def checkout(self):
+        """Returns a healthy connection, opening a new one while the pool has room"""
+
+        deadline = time.monotonic() + self.checkout_timeout
+        while True:
+            with self._available:
+                while not self._idle and self._created >= self.size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(
+                            "Timed out waiting for a connection from the pool"
+                        )
+                    self._available.wait(remaining)
+
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._created += 1
+                    conn = None
+
+            if conn is None:
+                return self._create()
+
+            # Connections idle for a while are checked before being handed out
+            idle_time = time.monotonic() - conn.last_used
+            if idle_time < self.health_check_interval or conn.is_healthy():
+                return conn
+
+            self._discard(conn)
+
+    def checkin(self, conn, discard=False):
+        """Returns a connection to the pool, or drops it if it is broken"""
+
+        if discard:
+            self._discard(conn)
+            return
+
+        conn.last_used = time.monotonic()
+        with self._available:
+            self._idle.append(conn)
+            self._available.notify()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except pyodbc.Error:
+            pass
+
+        with self._available:
+            self._created -= 1
+            self._available.notify()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of a with block"""
+
+        conn = self.checkout()
+        try:
+            yield conn
+        except Exception:
+            # A transaction left open by the failed block would be committed by the
+            # next user of the connection, so it is rolled back before the checkin
+            try:
+                conn.rollback()
+            except pyodbc.Error:
+                self.checkin(conn, discard=True)
+            else:
+                self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    def close(self):
+        with self._available:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
@@ -1,18 +1,24 @@
+import json
 import pyodbc
+from concurrent.futures import ThreadPoolExecutor
 from config import create_connection_string, db_config
+from db_pool import ConnectionPool
 from email_helper import send_email
 from datetime import datetime
-from tqdm import tqdm
+from progress import progress
 
 
 class ExampleDb:
     def __init__(self):
         try:
-            # DropshippSellerCloud database connection
-            self.conn_sc = pyodbc.connect(
-                create_connection_string(db_config["ExampleDb"])
+            # DropshippSellerCloud database connection pool
+            server_config = db_config["ExampleDb"]
+            self.pool = ConnectionPool(
+                create_connection_string(server_config),
+                size=server_config.get("pool_size", 4),
             )
-            self.cursor_sc = self.conn_sc.cursor()
+            # Opening the first connection up front so bad credentials fail early
+            self.pool.checkin(self.pool.checkout())
         except pyodbc.Error as e:
             print(f"Error establishing connection to the Example database: {e}")
             raise
@@ -22,15 +28,17 @@ class ExampleDb:
         try:
             file_name = file_path.split("\\")[-1]
 
-            self.cursor_sc.execute(
-                """
-                SELECT * FROM PurchaseOrderFiles 
-                WHERE file_name = ?
-                """,
-                file_name,
-            )
+            with self.pool.connection() as conn:
+                # Existence check answered from the file_name index
+                row = conn.execute(
+                    """
+                    SELECT TOP 1 1 FROM PurchaseOrderFiles
+                    WHERE file_name = ?
+                    """,
+                    file_name,
+                ).fetchone()
 
-            if self.cursor_sc.fetchone():
+            if row:
                 return False
             else:
                 return True
@@ -39,18 +47,72 @@ class ExampleDb:
             print(f"Error while checking for duplicate files: {e}")
             raise
 
+    def get_existing_file_names(self, file_names):
+        """Returns the subset of the file names already uploaded to the database"""
+        try:
+            existing = set()
+            file_names = list(set(file_names))
+
+            # Chunked to stay below the SQL Server parameter limit
+            with self.pool.connection() as conn:
+                for i in range(0, len(file_names), 1000):
+                    chunk = file_names[i : i + 1000]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    rows = conn.execute(
+                        f"""
+                        SELECT file_name FROM PurchaseOrderFiles
+                        WHERE file_name IN ({placeholders})
+                        """,
+                        *chunk,
+                    ).fetchall()
+                    existing.update(row.file_name for row in rows)
+
+            return existing
+
+        except Exception as e:
+            print(f"Error while checking for duplicate files: {e}")
+            raise
+
+    def get_existing_purchase_orders(self, purchase_order_numbers):
+        """Returns the subset of the purchase order numbers already stored in the database"""
+        try:
+            existing = set()
+            purchase_order_numbers = list(set(purchase_order_numbers))
+
+            # Chunked to stay below the SQL Server parameter limit
+            with self.pool.connection() as conn:
+                for i in range(0, len(purchase_order_numbers), 1000):
+                    chunk = purchase_order_numbers[i : i + 1000]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    rows = conn.execute(
+                        f"""
+                        SELECT purchase_order_number FROM PurchaseOrders
+                        WHERE purchase_order_number IN ({placeholders})
+                        """,
+                        *chunk,
+                    ).fetchall()
+                    existing.update(row.purchase_order_number for row in rows)
+
+            return existing
+
+        except Exception as e:
+            print(f"Error while checking for duplicate orders: {e}")
+            raise
+
     def check_for_duplicate_orders(self, purchase_order_number):
         """Check if the order has already been uploaded to the database"""
         try:
-            self.cursor_sc.execute(
-                """
-                SELECT * FROM PurchaseOrders
-                WHERE purchase_order_number = ?
-                """,
-                purchase_order_number,
-            )
+            with self.pool.connection() as conn:
+                # Existence check answered from the purchase_order_number index
+                row = conn.execute(
+                    """
+                    SELECT TOP 1 1 FROM PurchaseOrders
+                    WHERE purchase_order_number = ?
+                    """,
+                    purchase_order_number,
+                ).fetchone()
 
-            if self.cursor_sc.fetchone():
+            if row:
                 return True
             else:
                 return False
@@ -62,48 +124,155 @@ class ExampleDb:
     def store_file_names(self, file_name, pos, dropshipper_id, path):
         """Store the file name and purchase order numbers in the database"""
 
-        files_not_uploaded = []
+        return self.register_files(
+            [
+                {
+                    "dropshipper_id": dropshipper_id,
+                    "file_name": file_name,
+                    "pos": pos,
+                    "path": path,
+                }
+            ]
+        )
 
-        try:
-            self.cursor_sc.execute(
-                """
-                INSERT INTO PurchaseOrderFiles (dropshipper_id, file_name, date)
-                VALUES (?, ?, ?)
-                """,
-                dropshipper_id,
-                file_name,
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            )
+    def register_files(self, files):
+        """Store the file names and purchase order numbers of a whole run in one transaction. Returns the paths of the files that failed"""
+
+        if not files:
+            return []
+
+        with self.pool.connection() as conn:
+            try:
+                self._insert_files(conn, files)
+                conn.commit()
+                return []
 
-            file_id = self.cursor_sc.execute("SELECT @@IDENTITY AS id").fetchone().id
+            except Exception as e:
+                print(f"Error while storing the file paths in bulk: {e}")
+                conn.rollback()
+
+            # Falling back to one transaction per file to find the ones that failed
+            files_not_uploaded = []
+            for file in files:
+                try:
+                    self._insert_files(conn, [file])
+                    conn.commit()
+                except Exception as e:
+                    print(f"Error while storing the file path: {e}")
+                    conn.rollback()
+                    files_not_uploaded.append(file["path"])
 
-            self.cursor_sc.executemany(
+        if files_not_uploaded:
+            send_email(
+                "Error Uploading Files to Database",
+                f"Error uploading the following files to the database: {files_not_uploaded}",
+            )
+
+        return files_not_uploaded
+
+    def _insert_files(self, conn, files):
+        """Inserts the files and their purchase order numbers without committing"""
+
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        file_ids = {}
+
+        # 3 parameters per file, chunked to stay below the SQL Server parameter limit
+        for i in range(0, len(files), 600):
+            chunk = files[i : i + 600]
+            values = ", ".join("(?, ?, ?)" for _ in chunk)
+            params = [
+                value
+                for file in chunk
+                for value in (file["dropshipper_id"], file["file_name"], date)
+            ]
+            rows = conn.execute(
+                f"""
+                INSERT INTO PurchaseOrderFiles (dropshipper_id, file_name, date)
+                OUTPUT inserted.id, inserted.dropshipper_id, inserted.file_name
+                VALUES {values}
+                """,
+                *params,
+            ).fetchall()
+            for row in rows:
+                file_ids[(row.dropshipper_id, row.file_name)] = row.id
+
+        items = [
+            (file_ids[(file["dropshipper_id"], file["file_name"])], po)
+            for file in files
+            for po in file["pos"]
+        ]
+        if items:
+            conn.executemany(
                 """
                 INSERT INTO PurchaseOrderFileItems (purchase_order_file_id, purchase_order_number)
                 VALUES (?, ?)
                 """,
-                [(file_id, po) for po in pos],
+                items,
+                fast=True,
             )
 
-        except Exception as e:
-            print(f"Error while storing the file path: {e}")
-            files_not_uploaded.append(path)
+    def store_purchase_orders(
+        self, po_objs, origins=None, on_stored=None, max_workers=None
+    ):
+        """Store the purchase orders in the database. Each dropshipper's orders are written concurrently on their own connection.
+
+        Orders are grouped by the dropshipper they came from. origins maps purchase order
+        numbers to it when the shipping check moved them to another account. on_stored is
+        called with the dropshipper id as soon as that dropshipper's orders are committed.
+        max_workers defaults to the pool size, 1 writes the dropshippers serially in the
+        calling thread.
+        """
+
+        origins = origins or {}
+        orders_by_dropshipper = {}
+        for po_number, po_obj in po_objs.items():
+            dropshipper_id = origins.get(po_number, po_obj["dropshipper_id"])
+            orders_by_dropshipper.setdefault(dropshipper_id, []).append(po_obj)
+
+        # A single writer runs in the calling thread, so profilers see its work
+        if max_workers == 1:
+            for dropshipper_orders in orders_by_dropshipper.items():
+                self._store_dropshipper_orders(dropshipper_orders, on_stored)
+            return True
+
+        with ThreadPoolExecutor(max_workers=max_workers or self.pool.size) as executor:
+            list(
+                executor.map(
+                    lambda dropshipper_orders: self._store_dropshipper_orders(
+                        dropshipper_orders, on_stored
+                    ),
+                    orders_by_dropshipper.items(),
+                )
+            )
 
-        self.conn_sc.commit()
+        return True
 
-        if files_not_uploaded:
-            send_email(
-                "Error Uploading Files to Database",
-                f"Error uploading the following files to the database: {files_not_uploaded}",
-            )
+    def _store_dropshipper_orders(self, dropshipper_orders, on_stored=None):
+        """Store the purchase orders of one dropshipper in a single transaction"""
+
+        dropshipper_id, po_objs = dropshipper_orders
+
+        with self.pool.connection() as conn:
+            self._insert_purchase_orders(conn, po_objs, dropshipper_id)
 
-    def store_purchase_orders(self, po_objs):
-        """Store the purchase orders in the database"""
+        if on_stored:
+            on_stored(dropshipper_id)
+
+    def _insert_purchase_orders(self, conn, po_objs, dropshipper_id):
+        # Summaries of the orders in the open transaction, published to the outbox on commit
+        stored_orders = []
+
+        for po_obj in progress(
+            po_objs, desc=f"Storing purchase orders for dropshipper {dropshipper_id}"
+        ):
+            # A savepoint per order, so a failing order does not roll back the ones
+            # stored before it. The first order of a transaction has nothing to protect
+            if stored_orders:
+                conn.execute("SAVE TRANSACTION purchase_order")
 
-        for po_obj in tqdm(po_objs.values(), desc="Storing purchase orders"):
             try:
                 # Inserting into PurchaseOrders
-                self.cursor_sc.execute(
+                conn.execute(
                     """
                             INSERT INTO PurchaseOrders (
                                 purchase_order_number,
@@ -137,11 +306,11 @@ class ExampleDb:
                 )
 
                 purchase_order_id = (
-                    self.cursor_sc.execute("SELECT @@IDENTITY AS id").fetchone().id
+                    conn.execute("SELECT @@IDENTITY AS id").fetchone().id
                 )
 
                 for sku, quantity in po_obj["items"].items():
-                    self.cursor_sc.execute(
+                    conn.execute(
                         """
                                 INSERT INTO PurchaseOrderItems (
                                     purchase_order_id,
@@ -154,25 +323,117 @@ class ExampleDb:
                         quantity,
                     )
 
+                stored_orders.append(
+                    {
+                        "id": int(purchase_order_id),
+                        "purchase_order_number": po_obj["purchase_order_number"],
+                        "purchase_order_date": po_obj["purchase_order_date"],
+                        "dropshipper_id": po_obj["dropshipper_id"],
+                        "state": po_obj["state"],
+                        "country": po_obj["country"],
+                        "items": po_obj["items"],
+                    }
+                )
+
             except Exception as e:
                 print(f"Error while storing new purchase orders: {e}")
-                self.conn_sc.rollback()
-                send_email(
-                    "Error Storing Orders",
-                    f"The following error occurred while storing new purchase orders: {e}\norder: {po_obj} was unable to be stored in the ExampleDb.",
-                )
+                lost_orders = []
+                if stored_orders:
+                    try:
+                        conn.execute("ROLLBACK TRANSACTION purchase_order")
+                    except pyodbc.Error:
+                        # The error ended the whole transaction, the orders stored
+                        # before this one were rolled back with it
+                        conn.rollback()
+                        lost_orders = [
+                            order["purchase_order_number"] for order in stored_orders
+                        ]
+                        stored_orders = []
+                else:
+                    conn.rollback()
+
+                message = f"The following error occurred while storing new purchase orders: {e}\norder: {po_obj} was unable to be stored in the ExampleDb."
+                if lost_orders:
+                    message += f"\nThe error also rolled back these orders of dropshipper {dropshipper_id}, which were not stored either: {lost_orders}"
+                send_email("Error Storing Orders", message)
                 continue
 
-        self.conn_sc.commit()
+        if stored_orders:
+            self._insert_outbox_batch(conn, dropshipper_id, stored_orders)
+
+        conn.commit()
+
+    def _insert_outbox_batch(self, conn, dropshipper_id, stored_orders):
+        """Publishes the orders of a batch to the outbox in the transaction that stores them.
+
+        Consumers follow the outbox by id, so ids must become visible in order. The
+        lock, held until the commit, makes concurrent batches take their ids in the
+        order they commit.
+        """
+
+        conn.execute(
+            """
+            DECLARE @result INT;
+            EXEC @result = sp_getapplock
+                @Resource = 'OrderOutbox',
+                @LockMode = 'Exclusive',
+                @LockOwner = 'Transaction',
+                @LockTimeout = 60000;
+            IF @result < 0
+                THROW 50000, 'Timed out waiting for the order outbox lock', 1;
+            """
+        )
+        conn.execute(
+            """
+            INSERT INTO OrderOutbox (dropshipper_id, order_count, payload, created_at)
+            VALUES (?, ?, ?, ?)
+            """,
+            dropshipper_id,
+            len(stored_orders),
+            json.dumps(stored_orders),
+            datetime.now(),
+        )
+
+    def read_outbox(self, after_id=0, limit=100):
+        """Returns the outbox batches published after after_id, oldest first.
+
+        Consumers keep the id of the last batch they handled and pass it on the next call.
+        """
+        try:
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT TOP (?) id, dropshipper_id, order_count, payload, created_at
+                    FROM OrderOutbox
+                    WHERE id > ?
+                    ORDER BY id
+                    """,
+                    limit,
+                    after_id,
+                ).fetchall()
+
+            return [
+                {
+                    "id": row.id,
+                    "dropshipper_id": row.dropshipper_id,
+                    "order_count": row.order_count,
+                    "created_at": row.created_at,
+                    "orders": json.loads(row.payload),
+                }
+                for row in rows
+            ]
 
-        return True
+        except Exception as e:
+            print(f"Error while reading the order outbox: {e}")
+            raise
 
     def load_dropship_data(self):
         """Load dropshipper data from the database"""
 
         try:
-            self.cursor_sc.execute(
-                """
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    """
                 SELECT 
                     d.id,
                     d.name,
@@ -200,10 +461,10 @@ class ExampleDb:
                 ORDER BY 
                     d.name;
                 """
-            )
+                ).fetchall()
             dropshipper_data = {}
 
-            for row in self.cursor_sc.fetchall():
+            for row in rows:
                 dropshipper_data[row.ftp_folder_name] = {
                     "id": row.id,
                     "name": row.name,
@@ -221,12 +482,70 @@ class ExampleDb:
             print(f"Error while getting data from the Dropship database: {e}")
             raise
 
+    def get_allowed_skus_fingerprints(self):
+        """Returns a cheap fingerprint of each dropshipper's allowed SKU catalog to detect changes"""
+
+        try:
+            with self.pool.connection() as conn:
+                # Databases without the allow-list table have no allow-lists
+                if not conn.execute(
+                    "SELECT OBJECT_ID('DropshipperAllowedSkus', 'U')"
+                ).fetchone()[0]:
+                    return {}
+
+                rows = conn.execute(
+                    """
+                    SELECT
+                        dropshipper_id,
+                        COUNT(*) AS sku_count,
+                        CHECKSUM_AGG(CHECKSUM(sku)) AS sku_checksum
+                    FROM DropshipperAllowedSkus
+                    GROUP BY dropshipper_id
+                    """
+                ).fetchall()
+
+            return {
+                row.dropshipper_id: (row.sku_count, row.sku_checksum) for row in rows
+            }
+
+        except Exception as e:
+            print(f"Error while getting the allowed skus fingerprints: {e}")
+            raise
+
+    def load_allowed_skus(self, dropshipper_ids):
+        """Returns the allowed SKUs of the dropshippers"""
+
+        try:
+            allowed_skus = {dropshipper_id: [] for dropshipper_id in dropshipper_ids}
+
+            # Chunked to stay below the SQL Server parameter limit
+            with self.pool.connection() as conn:
+                for i in range(0, len(dropshipper_ids), 1000):
+                    chunk = dropshipper_ids[i : i + 1000]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    rows = conn.execute(
+                        f"""
+                        SELECT dropshipper_id, sku FROM DropshipperAllowedSkus
+                        WHERE dropshipper_id IN ({placeholders})
+                        """,
+                        *chunk,
+                    ).fetchall()
+                    for row in rows:
+                        allowed_skus[row.dropshipper_id].append(row.sku)
+
+            return allowed_skus
+
+        except Exception as e:
+            print(f"Error while loading the allowed skus: {e}")
+            raise
+
     def get_country_and_states(self):
         """Get country and states from the database"""
 
         try:
-            self.cursor_sc.execute(
-                """
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    """
                 SELECT
                     c.name as country_name,
                     c.two_letter_code,
@@ -236,9 +555,8 @@ class ExampleDb:
                 FROM Countries c
                 JOIN States s ON s.country_id = c.id
                 """
-            )
+                ).fetchall()
 
-            rows = self.cursor_sc.fetchall()
             if rows:
                 result = {}
                 for row in rows:
@@ -266,9 +584,8 @@ class ExampleDb:
                     FROM FileFormatDetails ffd
                     INNER JOIN HeaderMappings hm ON ffd.header_mapping_id = hm.id
                     """
-            self.cursor_sc.execute(query)
-
-            rows = self.cursor_sc.fetchall()
+            with self.pool.connection() as conn:
+                rows = conn.execute(query).fetchall()
 
             header_variants = {}
             for normalized_name, variant in rows:
@@ -286,13 +603,14 @@ class ExampleDb:
     def load_excluded_shipping_states(self):
         """Returns a list of state codes where our shipping account does not ship to"""
         try:
-            self.cursor_sc.execute(
-                """
-                SELECT DISTINCT s.code FROM States s
-                JOIN ExcludedShippingStates ess ON ess.state_id = s.id
-                """
-            )
-            return [row.code for row in self.cursor_sc.fetchall()]
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT DISTINCT s.code FROM States s
+                    JOIN ExcludedShippingStates ess ON ess.state_id = s.id
+                    """
+                ).fetchall()
+            return [row.code for row in rows]
 
         except Exception as e:
             print(f"Error while getting excluded shipping states: {e}")
@@ -302,17 +620,17 @@ class ExampleDb:
         """Get the international dropshipper shipping accounts"""
 
         try:
-            self.cursor_sc.execute(
-                """
-                SELECT id, code FROM Dropshippers
-                WHERE name LIKE '%international%'
-                """
-            )
+            # The rows are fetched before the connection is returned, since
+            # _get_dropshipper_id checks out its own connection
+            with self.pool.connection() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, code FROM Dropshippers
+                    WHERE name LIKE '%international%'
+                    """
+                ).fetchall()
 
-            return {
-                self._get_dropshipper_id(row.code): row.id
-                for row in self.cursor_sc.fetchall()
-            }
+            return {self._get_dropshipper_id(row.code): row.id for row in rows}
 
         except Exception as e:
             print(f"Error while getting international accounts: {e}")
@@ -322,18 +640,109 @@ class ExampleDb:
         """Get the dropshipper id from the database"""
 
         try:
-            self.cursor_sc.execute(
-                """
-                SELECT id FROM Dropshippers
-                WHERE code = ?
-                """,
-                dropshipper_code,
-            )
-            return self.cursor_sc.fetchone().id
+            with self.pool.connection() as conn:
+                return (
+                    conn.execute(
+                        """
+                        SELECT id FROM Dropshippers
+                        WHERE code = ?
+                        """,
+                        dropshipper_code,
+                    )
+                    .fetchone()
+                    .id
+                )
         except Exception as e:
             print(f"Error while getting dropshipper id: {e}")
             raise
 
+    def claim_folder_lease(self, folder_name, worker_id, now, expires_at):
+        """Claims a folder if it is free, expired or already held by the worker. Returns True if the worker holds it"""
+        try:
+            with self.pool.connection() as conn:
+                # Taking over an expired lease, or extending our own, is a single conditional update
+                cursor = conn.execute(
+                    """
+                    UPDATE FolderLeases
+                    SET worker_id = ?, expires_at = ?
+                    WHERE folder_name = ? AND (worker_id = ? OR expires_at < ?)
+                    """,
+                    worker_id,
+                    expires_at,
+                    folder_name,
+                    worker_id,
+                    now,
+                )
+                if cursor.rowcount == 1:
+                    conn.commit()
+                    return True
+
+                # The primary key lets only one of the workers racing for a new folder insert it
+                try:
+                    conn.execute(
+                        """
+                        INSERT INTO FolderLeases (folder_name, worker_id, expires_at)
+                        VALUES (?, ?, ?)
+                        """,
+                        folder_name,
+                        worker_id,
+                        expires_at,
+                    )
+                    conn.commit()
+                    return True
+                except pyodbc.IntegrityError:
+                    conn.rollback()
+                    return False
+
+        except Exception as e:
+            print(f"Error while claiming the folder lease: {e}")
+            raise
+
+    def renew_folder_leases(self, folder_names, worker_id, now, expires_at):
+        """Extends the unexpired leases of the worker. Returns the folders it still holds"""
+        try:
+            renewed = set()
+            with self.pool.connection() as conn:
+                for folder_name in folder_names:
+                    cursor = conn.execute(
+                        """
+                        UPDATE FolderLeases
+                        SET expires_at = ?
+                        WHERE folder_name = ? AND worker_id = ? AND expires_at >= ?
+                        """,
+                        expires_at,
+                        folder_name,
+                        worker_id,
+                        now,
+                    )
+                    if cursor.rowcount == 1:
+                        renewed.add(folder_name)
+                conn.commit()
+
+            return renewed
+
+        except Exception as e:
+            print(f"Error while renewing the folder leases: {e}")
+            raise
+
+    def release_folder_leases(self, folder_names, worker_id):
+        """Releases the leases the worker holds so other workers can claim the folders right away"""
+        try:
+            with self.pool.connection() as conn:
+                for folder_name in folder_names:
+                    conn.execute(
+                        """
+                        DELETE FROM FolderLeases
+                        WHERE folder_name = ? AND worker_id = ?
+                        """,
+                        folder_name,
+                        worker_id,
+                    )
+                conn.commit()
+
+        except Exception as e:
+            print(f"Error while releasing the folder leases: {e}")
+            raise
+
     def close(self):
-        self.cursor_sc.close()
-        self.conn_sc.close()
+        self.pool.close()
@@ -0,0 +1,104 @@
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from config import folder_leases
+from dropship_db import ExampleDb
+
+
+class FolderLeases:
+    """Leases on dropshipper folders stored in the database, renewed by a heartbeat thread.
+
+    Every worker only processes the folders it could claim. When a worker dies its
+    leases expire and the next worker to run claims the folders. The FolderLeases
+    table is created by migrations.py.
+    """
+
+    def __init__(
+        self,
+        d_db: ExampleDb,
+        worker_id=None,
+        ttl_seconds=folder_leases["ttl_seconds"],
+        heartbeat_seconds=folder_leases["heartbeat_seconds"],
+    ):
+        self.d_db = d_db
+        self.worker_id = (
+            worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        )
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.heartbeat_seconds = heartbeat_seconds
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _now(self):
+        # Timestamps are passed as UTC parameters so every worker compares the same clock
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    def claim(self, folder_name):
+        """Claims a folder for this worker. Returns False if another worker holds it"""
+
+        now = self._now()
+        claimed = self.d_db.claim_folder_lease(
+            folder_name, self.worker_id, now, now + self.ttl
+        )
+        if claimed:
+            with self._lock:
+                self._held.add(folder_name)
+                if self._heartbeat is None:
+                    self._heartbeat = threading.Thread(
+                        target=self._renew_loop, name="folder-leases", daemon=True
+                    )
+                    self._heartbeat.start()
+
+        return claimed
+
+    def holds(self, folder_name):
+        with self._lock:
+            return folder_name in self._held
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.heartbeat_seconds):
+            with self._lock:
+                held = set(self._held)
+            if not held:
+                continue
+
+            try:
+                now = self._now()
+                renewed = self.d_db.renew_folder_leases(
+                    held, self.worker_id, now, now + self.ttl
+                )
+            except Exception:
+                # The leases are retried on the next heartbeat, before they expire
+                continue
+
+            lost = held - renewed
+            if lost:
+                print(f"Folder leases lost by worker {self.worker_id}: {sorted(lost)}")
+                with self._lock:
+                    self._held -= lost
+
+    def release(self, folder_names=None):
+        """Releases the given folders, or every folder held by this worker"""
+
+        with self._lock:
+            folder_names = set(self._held if folder_names is None else folder_names)
+            self._held -= folder_names
+
+        if folder_names:
+            self.d_db.release_folder_leases(folder_names, self.worker_id)
+
+    def close(self):
+        """Stops the heartbeat and releases the folders still held"""
+
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+
+        try:
+            self.release()
+        except Exception as e:
+            print(f"Error while releasing the folder leases: {e}")
@@ -1,75 +1,264 @@
 import os
 import ftplib
 import pathlib
+import time
 from datetime import datetime
-from config import ftp_server
-from tqdm import tqdm
+from circuit_breaker import CircuitBreaker
+from config import ftp_server, ftp_transfer
+from local_spool import LocalSpool
+from progress import progress
+
+
+class IncompleteTransferError(Exception):
+    """The downloaded file does not match the size reported by the server"""
 
 
 class FTPManager:
-    def __init__(self):
+    def __init__(self, spool=None, breaker=None):
         self.host = ftp_server["server"]
         self.username = ftp_server["username"]
         self.password = ftp_server["password"]
+        # Local folder the downloads land in
+        self.spool = spool or LocalSpool()
+        # Folders failing run after run are skipped for a while
+        self.breaker = breaker or CircuitBreaker()
 
-    def _create_local_dir(self, customer_name):
-        """Create a local directory to store the downloaded files"""
+    def download_files(self, ftp_folder_name, skip=None):
+        """Download order files from the FTP server. Files named in skip are already on disk"""
 
-        datetime_now = datetime.now().strftime("%Y%m%d_%H%M%S")
-        local_dir = pathlib.Path(f"tmp/{customer_name}/{datetime_now}/")
-        local_dir.mkdir(parents=True, exist_ok=True)
-        return local_dir
+        skip = skip or set()
 
-    def download_files(self, ftp_folder_name):
-        """Download order files from the FTP server"""
+        if not self.breaker.allow(ftp_folder_name):
+            print(f"Skipping {ftp_folder_name}, its FTP folder keeps failing")
+            return None
 
-        try:
-            # Starting connection to FTP
-            self.ftp = ftplib.FTP(self.host)
-            self.ftp.login(self.username, self.password)
+        # remote_folder = f"test_dropshipper/{ftp_folder_name}/orders"
+        remote_folder = f"dropshipper/{ftp_folder_name}/orders"
 
-            # remote_folder = f"test_dropshipper/{ftp_folder_name}/orders"
-            remote_folder = f"dropshipper/{ftp_folder_name}/orders"
+        # A connection per call so several folders can be downloaded concurrently
+        ftp = None
 
-            files = self.ftp.nlst(remote_folder)
+        try:
+            # Starting connection to FTP
+            ftp, files = self._list_with_retries(remote_folder)
 
             # Create the local directory for downloads
-            local_dir = self._create_local_dir(ftp_folder_name)
+            local_dir = self.spool.create_dir(ftp_folder_name)
 
-            for file in tqdm(files, desc=f"Downloading {ftp_folder_name} files"):
+            attempted = 0
+            failed = 0
+            last_error = None
+            for file in progress(files, desc=f"Downloading {ftp_folder_name} files"):
                 # Skip directories
                 if file.endswith("/"):
                     continue
 
+                # Skip files a previous run already downloaded
+                if pathlib.Path(file).name in skip:
+                    continue
+
                 # Construct the local file path
                 local_file_path = local_dir / pathlib.Path(file).name
 
-                # Download the file
-                with open(local_file_path, "wb") as local_file:
-                    self.ftp.retrbinary(
-                        f"RETR {remote_folder}/{pathlib.Path(file).name}",
-                        local_file.write,
+                # Download the file. A file that keeps failing is left for the next
+                # run without discarding the ones already downloaded
+                attempted += 1
+                try:
+                    ftp = self._download_file(
+                        ftp,
+                        f"{remote_folder}/{pathlib.Path(file).name}",
+                        local_file_path,
                     )
+                except (*ftplib.all_errors, IncompleteTransferError) as e:
+                    ftp = None
+                    failed += 1
+                    last_error = e
+                    print(f"There was an error downloading {file}: {e}")
 
-            self.ftp.quit()
+            if ftp:
+                ftp.quit()
+
+            # A folder only counts as failing when none of its files could be downloaded
+            if attempted and failed == attempted:
+                self.breaker.record_failure(ftp_folder_name, last_error)
+            else:
+                self.breaker.record_success(ftp_folder_name)
 
             return str(local_dir)
 
         except ftplib.all_errors as e:
             # Closing
-            self.ftp.quit()
+            if ftp:
+                ftp.close()
 
+            self.breaker.record_failure(ftp_folder_name, e)
             print(f"There was an error downloading order files from FTP server: {e}")
 
+    def _backoff(self, attempt):
+        """Sleeps before a retry, doubling the wait on every attempt"""
+
+        time.sleep(
+            min(
+                ftp_transfer["backoff_seconds"] * 2 ** (attempt - 1),
+                ftp_transfer["max_backoff_seconds"],
+            )
+        )
+
+    def _list_with_retries(self, remote_folder):
+        """Connects and lists a folder, retrying with backoff. Returns the connection and the files"""
+
+        for attempt in range(1, ftp_transfer["max_attempts"] + 1):
+            ftp = None
+            try:
+                ftp = self._connect()
+                return ftp, ftp.nlst(remote_folder)
+
+            except ftplib.all_errors as e:
+                if ftp:
+                    ftp.close()
+                if attempt == ftp_transfer["max_attempts"]:
+                    raise
+                print(f"Error listing {remote_folder}, retrying: {e}")
+                self._backoff(attempt)
+
+    def _download_file(self, ftp, remote_path, local_path):
+        """Download a file into a .part file, resuming with REST after a dropped connection.
+
+        The file is renamed into place only once its size matches the size reported
+        by the server. Returns the connection in use, which is replaced when it drops.
+        """
+
+        part_path = f"{local_path}.part"
+
+        for attempt in range(1, ftp_transfer["max_attempts"] + 1):
+            try:
+                if ftp is None:
+                    ftp = self._connect()
+
+                # SIZE and REST offsets are only reliable in binary mode
+                ftp.voidcmd("TYPE I")
+                try:
+                    remote_size = ftp.size(remote_path)
+                except ftplib.error_perm:
+                    remote_size = None
+
+                offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                if remote_size is not None and offset > remote_size:
+                    offset = 0
+
+                if remote_size is None or offset < remote_size:
+                    with open(part_path, "ab" if offset else "wb") as local_file:
+                        ftp.retrbinary(
+                            f"RETR {remote_path}",
+                            local_file.write,
+                            rest=offset or None,
+                        )
+
+                local_size = os.path.getsize(part_path)
+                if remote_size is not None and local_size != remote_size:
+                    raise IncompleteTransferError(
+                        f"{remote_path} is {local_size} bytes, the server reports {remote_size}"
+                    )
+
+                os.replace(part_path, local_path)
+                return ftp
+
+            except (*ftplib.all_errors, IncompleteTransferError) as e:
+                if ftp:
+                    ftp.close()
+                ftp = None
+
+                if attempt == ftp_transfer["max_attempts"]:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise
+
+                print(f"Error downloading {remote_path}, attempt {attempt}: {e}")
+                self._backoff(attempt)
+
+    def _connect(self):
+        ftp = ftplib.FTP(self.host, timeout=ftp_transfer["connect_timeout"])
+        ftp.login(self.username, self.password)
+        # The control connection uses the command timeout, data connections
+        # are opened with ftp.timeout
+        ftp.sock.settimeout(ftp_transfer["command_timeout"])
+        ftp.timeout = ftp_transfer["transfer_timeout"]
+        return ftp
+
+    def list_files(self, remote_folder):
+        """List the files of a folder with their size and modification time"""
+
+        ftp = self._connect()
+        try:
+            files = []
+            try:
+                for name, facts in ftp.mlsd(
+                    remote_folder, facts=["type", "size", "modify"]
+                ):
+                    if facts.get("type") != "file":
+                        continue
+                    files.append(
+                        (
+                            name,
+                            int(facts.get("size", 0)),
+                            datetime.strptime(facts["modify"][:14], "%Y%m%d%H%M%S"),
+                        )
+                    )
+            except ftplib.error_perm:
+                # Servers without MLSD are listed one file at a time
+                ftp.voidcmd("TYPE I")
+                for file in ftp.nlst(remote_folder):
+                    name = pathlib.Path(file).name
+                    modified = ftp.voidcmd(f"MDTM {remote_folder}/{name}")[4:].strip()
+                    files.append(
+                        (
+                            name,
+                            ftp.size(f"{remote_folder}/{name}") or 0,
+                            datetime.strptime(modified[:14], "%Y%m%d%H%M%S"),
+                        )
+                    )
+
+            ftp.quit()
+            return files
+
+        except ftplib.all_errors:
+            ftp.close()
+            raise
+
+    def download_batch(self, remote_folder, file_names, local_dir):
+        """Download a batch of files over one connection. Returns the local paths of the files downloaded"""
+
+        local_dir = pathlib.Path(local_dir)
+        local_dir.mkdir(parents=True, exist_ok=True)
+
+        ftp = None
+        local_paths = []
+        for file_name in file_names:
+            local_file_path = local_dir / file_name
+            try:
+                ftp = self._download_file(
+                    ftp, f"{remote_folder}/{file_name}", local_file_path
+                )
+                local_paths.append(str(local_file_path))
+            except (*ftplib.all_errors, IncompleteTransferError) as e:
+                ftp = None
+                print(f"There was an error downloading {file_name}: {e}")
+
+        if ftp:
+            ftp.quit()
+
+        return local_paths
+
     def moving_files(self, all_files, destination, remove_from_tmp=False):
-        """Move files to the logs folder in the FTP server"""
+        """Move files to the logs folder in the FTP server. Returns the moved file paths"""
+
+        moved_files = []
 
         try:
             # Starting connection to FTP
-            self.ftp = ftplib.FTP(self.host)
-            self.ftp.login(self.username, self.password)
+            self.ftp = self._connect()
 
-            for dropshiper_file_path in tqdm(
+            for dropshiper_file_path in progress(
                 all_files.values(), desc=f"Moving valid files to {destination}"
             ):
                 for tupple in dropshiper_file_path:
@@ -83,7 +272,7 @@ class FTPManager:
                         # Removing file from tmp folder
                         os.remove(file_path)
 
-                    ftp_folder_name = file_path.split("\\")[1]
+                    ftp_folder_name = self.spool.folder_name(file_path)
                     file_name = file_path.split("\\")[-1]
 
                     origin_folder = (
@@ -96,6 +285,7 @@ class FTPManager:
 
                     try:
                         self.ftp.rename(origin_folder, log_folder)
+                        moved_files.append(file_path)
                         print(
                             f"File moved successfully from {origin_folder} to {log_folder}"
                         )
@@ -110,3 +300,5 @@ class FTPManager:
 
         except ftplib.all_errors as e:
             print(f"There was an error removing files from FTP server: {e}")
+
+        return moved_files
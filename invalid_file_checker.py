@@ -1,104 +1,290 @@
 from typing import Callable
-import pandas as pd
+from compressed_files import has_content, inner_name
 from dropship_db import ExampleDb
-from xlsx_parser import XlsxParser
-from tqdm import tqdm
+from xlsx_parser import EXCEL_EXTENSIONS, XlsxParser
+from progress import progress
+import time
 import os
 
 
-class InvalidFileChecker:
-    def __init__(self, d_db: ExampleDb, parser: XlsxParser):
+class Rule:
+    """A validation rule, the shared inputs it needs and its running statistics"""
+
+    def __init__(self, name, check, needs=(), cost=1e-3, stage=0):
+        self.name = name
+        self.check = check
+        self.needs = tuple(needs)
+        # Rules of a stage only run once the earlier stages passed: the content
+        # checks assume the template matched, and the template check assumes a
+        # readable file. Only the rules within a stage are reordered
+        self.stage = stage
+        # Static cost estimate in seconds, used until the rule has been measured
+        self.cost = cost
+        self.calls = 0
+        self.rejections = 0
+        self.total_time = 0.0
+
+    def rank(self):
+        """Stage, then expected cost per rejection. Cheap and selective rules run first within a stage"""
+
+        avg_time = self.total_time / self.calls if self.calls else self.cost
+        # Laplace smoothing so unmeasured rules are not treated as never rejecting
+        rejection_rate = (self.rejections + 1) / (self.calls + 2)
+        return self.stage, avg_time / rejection_rate
+
+    def run(self, ctx):
+        """Run the rule against a file context and record timing and rejections"""
+
+        start = time.perf_counter()
+        try:
+            valid, reason = self.check(ctx)
+        finally:
+            self.total_time += time.perf_counter() - start
+            self.calls += 1
+
+        if not valid:
+            self.rejections += 1
+
+        return valid, reason
+
+
+class FileContext:
+    """Lazily computed inputs shared by all the rules checking a file"""
+
+    def __init__(self, file_path, providers):
+        self.file_path = file_path
+        self._providers = providers
+        self._values = {}
+
+    def get(self, name):
+        if name not in self._values:
+            self._values[name] = self._providers[name](self)
+        return self._values[name]
+
+
+class CompiledRuleSet:
+    """The rules for one dropshipper, compiled once and reordered as they are measured"""
+
+    def __init__(self, rules, d_db: ExampleDb, parser: XlsxParser):
+        self.rules = rules
         self.d_db = d_db
         self.parser = parser
 
-    def _check(self, file_path: str, rule: Callable[[str], bool]) -> bool:
-        """Check if a file passes a rule"""
+    def _providers(self, folder_inputs):
+        """Builds the input providers for the files of a folder"""
 
-        return rule(file_path)
+        providers = {
+            "file_name": lambda ctx: ctx.file_path.split("\\")[-1],
+            # The csv inside an archive is what the rules check
+            "inner_name": lambda ctx: inner_name(ctx.file_path),
+            "has_content": lambda ctx: has_content(ctx.file_path),
+            "header": self._read_header,
+            "frame": self._read_frame,
+            "standardized_frame": self._standardize_frame,
+        }
+        # Folder level inputs are computed once for every file in the folder
+        for name, value in folder_inputs.items():
+            providers[name] = lambda ctx, value=value: value
 
-    def validate_files(self, file_path, header_template):
-        """Validate files in a folder"""
+        return providers
+
+    def _read_header(self, ctx):
+        """Reads the header of the file, removing the spaces from the column names"""
+
+        columns = self.parser._df_reader(ctx.file_path, nrows=0).columns.tolist()
+        return [column.replace(" ", "") for column in columns]
+
+    def _read_frame(self, ctx):
+        # Spaces are removed from the column names in memory, archives can't be rewritten
+        df = self.parser._df_reader(ctx.file_path)
+        df.columns = [column.replace(" ", "") for column in df.columns]
+        return df
+
+    def _standardize_frame(self, ctx):
+        df = ctx.get("frame").dropna(how="all")
+        return self.parser.standardize_columns(df)
+
+    def _batch_inputs(self, file_paths):
+        """Computes the DB backed inputs for a whole folder in a single round-trip"""
+
+        needs = {need for rule in self.rules for need in rule.needs}
+        folder_inputs = {}
+
+        if "duplicate_files" in needs:
+            file_names = [file_path.split("\\")[-1] for file_path in file_paths]
+            folder_inputs["duplicate_files"] = self.d_db.get_existing_file_names(
+                file_names
+            )
+
+        return folder_inputs
+
+    def validate(self, file_paths, desc=None):
+        """Validates a list of files returning the valid and invalid ones"""
 
         invalid_files = []
         valid_files = []
 
-        # Checking if file is invalid
-        for root, dirs, files in os.walk(file_path):
-            for file in tqdm(files, desc=f"Checking for valid files in folder{root}"):
-                # Getting the header template for the specific customer
-                full_path = os.path.join(root, file)
-                # Validity flag
-                is_valid = True
-
-                # List of rules NOTE: add more if needed
-                rules = [
-                    is_not_empty,
-                    is_csv,
-                    follows_template(header_template, self.parser),
-                    is_not_duplicate(self.d_db),
-                    it_has_required_content(self.parser),
-                ]
-
-                # Checking if file is invalid
-                for rule in rules:
-                    valid, reason = self._check(full_path, rule)
-                    if not valid:
-                        invalid_files.append((full_path, reason))
-
-                        is_valid = False
-
-                        print(f"File {full_path} is invalid")
-                        break
-
-                if is_valid:
-                    valid_files.append(full_path)
+        if not file_paths:
+            return valid_files, invalid_files
+
+        providers = self._providers(self._batch_inputs(file_paths))
+
+        for full_path in progress(file_paths, desc=desc):
+            ctx = FileContext(full_path, providers)
+            is_valid = True
+
+            # The order is refreshed per file as the measurements come in
+            for rule in sorted(self.rules, key=Rule.rank):
+                try:
+                    valid, reason = rule.run(ctx)
+                except Exception as e:
+                    valid, reason = False, f"There was an error running {rule.name}"
+                    print(f"Error running {rule.name} on {full_path}: {e}")
+
+                if not valid:
+                    invalid_files.append((full_path, reason))
+
+                    is_valid = False
+
+                    print(f"File {full_path} is invalid")
+                    break
+
+            if is_valid:
+                valid_files.append(full_path)
 
         return valid_files, invalid_files
 
 
-def clean_and_save_csv(csv_file_path):
-    # Read the CSV into a DataFrame
-    df = pd.read_csv(csv_file_path)
+class InvalidFileChecker:
+    def __init__(self, d_db: ExampleDb, parser: XlsxParser):
+        self.d_db = d_db
+        self.parser = parser
+        self._compiled = {}
+
+    def compile_rules(self, header_template, exclude=()):
+        """Compiles the rule set for a header template once and caches it. Rules named in exclude are left out"""
+
+        key = (tuple(header_template), tuple(sorted(exclude)))
+        if key not in self._compiled:
+            # List of rules NOTE: add more if needed
+            rules = [
+                Rule("is_not_empty", is_not_empty, needs=("has_content",), cost=1e-5),
+                Rule(
+                    "is_supported_format",
+                    is_supported_format,
+                    needs=("inner_name",),
+                    cost=1e-5,
+                ),
+                Rule(
+                    "is_not_duplicate",
+                    is_not_duplicate,
+                    needs=("file_name", "duplicate_files"),
+                    cost=1e-6,
+                ),
+                Rule(
+                    "follows_template",
+                    follows_template(header_template),
+                    needs=("header",),
+                    cost=1e-3,
+                    stage=1,
+                ),
+                Rule(
+                    "it_has_required_content",
+                    it_has_required_content,
+                    needs=("standardized_frame",),
+                    cost=1e-2,
+                    stage=2,
+                ),
+            ]
+            rules = [rule for rule in rules if rule.name not in exclude]
+            self._compiled[key] = CompiledRuleSet(rules, self.d_db, self.parser)
 
-    # Remove spaces from column headers
-    df.columns = df.columns.str.replace(" ", "", regex=True)
+        return self._compiled[key]
 
-    # Save the DataFrame back to the same CSV file
-    df.to_csv(csv_file_path, index=False)
+    def validate_files(self, file_path, header_template):
+        """Validate files in a folder"""
+
+        file_paths = [
+            os.path.join(root, file)
+            for root, dirs, files in os.walk(file_path)
+            for file in files
+        ]
+
+        return self.validate_paths(
+            file_paths,
+            header_template,
+            desc=f"Checking for valid files in folder {file_path}",
+        )
+
+    def validate_paths(self, file_paths, header_template, desc=None, exclude=()):
+        """Validate a list of files"""
+
+        rule_set = self.compile_rules(header_template, exclude)
+        return rule_set.validate(file_paths, desc=desc)
+
+    def rule_stats(self):
+        """Returns the timing and rejection counts of every compiled rule"""
+
+        stats = []
+        for (header_template, _), rule_set in self._compiled.items():
+            for rule in rule_set.rules:
+                stats.append(
+                    {
+                        "template": header_template,
+                        "rule": rule.name,
+                        "calls": rule.calls,
+                        "rejections": rule.rejections,
+                        "total_time": rule.total_time,
+                    }
+                )
+        return stats
+
+    def print_rule_stats(self):
+        """Prints the timing and rejection counts of every rule"""
+
+        totals = {}
+        for stat in self.rule_stats():
+            total = totals.setdefault(
+                stat["rule"], {"calls": 0, "rejections": 0, "total_time": 0.0}
+            )
+            total["calls"] += stat["calls"]
+            total["rejections"] += stat["rejections"]
+            total["total_time"] += stat["total_time"]
+
+        for rule_name, total in totals.items():
+            print(
+                f"Rule {rule_name}: {total['calls']} calls, "
+                f"{total['rejections']} rejections, {total['total_time']:.3f}s"
+            )
 
 
 # Rules for checking files ========================================
-def is_not_empty(file_path: str) -> bool:
+def is_not_empty(ctx: FileContext) -> tuple:
     """Check if a file is empty"""
 
-    result = os.path.getsize(file_path) > 0
+    result = ctx.get("has_content")
     if result:
         return True, None
     else:
         return False, "File is empty"
 
 
-def is_csv(file_path: str) -> bool:
-    """Check if a file is a csv"""
+def is_supported_format(ctx: FileContext) -> tuple:
+    """Check if a file, or the file inside an archive, is a csv or an excel workbook"""
 
-    result = file_path.endswith(".csv")
+    result = ctx.get("inner_name").lower().endswith((".csv", *EXCEL_EXTENSIONS))
     if result:
         return True, None
     else:
-        return False, "File is not a csv"
+        return False, "File is not a csv or xlsx"
 
 
-def follows_template(
-    header_template: list, parser: XlsxParser
-) -> Callable[[str], bool]:
+def follows_template(header_template: list) -> Callable[[FileContext], tuple]:
     """Check if a file follows a template"""
 
-    def check_template(file_path: str) -> bool:
+    def check_template(ctx: FileContext) -> tuple:
         try:
-            clean_and_save_csv(file_path)
-
-            df = parser._df_reader(file_path)
-            columns = df.columns.tolist()
+            columns = ctx.get("header")
 
             result = columns == header_template
             if result:
@@ -112,55 +298,43 @@ def follows_template(
     return check_template
 
 
-def is_not_duplicate(d_db: ExampleDb) -> Callable[[str], bool]:
+def is_not_duplicate(ctx: FileContext) -> tuple:
     """Check if a file is a duplicate"""
 
-    def check_for_duplicate(file_path: str) -> bool:
-        result = d_db.check_for_duplicate(file_path)
-        if result:
-            return True, None
-        else:
-            return False, "File is a duplicate"
-
-    return check_for_duplicate
+    result = ctx.get("file_name") not in ctx.get("duplicate_files")
+    if result:
+        return True, None
+    else:
+        return False, "File is a duplicate"
 
 
-def it_has_required_content(parser: XlsxParser) -> Callable[[str], bool]:
+def it_has_required_content(ctx: FileContext) -> tuple:
     """Check if a file has required content"""
 
-    def check_column_values(file_path: str) -> bool:
-        try:
-            df = parser._df_reader(file_path)
-            df.dropna(how="all", inplace=True)
-
-            required_columns = [
-                "purchase_order_number",
-                "customer_first_name",
-                "address_1",
-                "city",
-                "country",
-                "state",
-                "zip",
-                "sku",
-                "quantity",
-            ]
-
-            df = parser.standardize_columns(df)
-
-            for column in required_columns:
-                values = df[column].tolist()
-                values = [value for value in values if pd.notna(value)]
-
-                result = len(values) > 0
-
-                if not result:
-                    return False, f"Column {column} is empty"
-                else:
-                    continue
-
-            return True, None
+    try:
+        df = ctx.get("standardized_frame")
+
+        required_columns = [
+            "purchase_order_number",
+            "customer_first_name",
+            "address_1",
+            "city",
+            "country",
+            "state",
+            "zip",
+            "sku",
+            "quantity",
+        ]
+
+        for column in required_columns:
+            result = df[column].notna().any()
+
+            if not result:
+                return False, f"Column {column} is empty"
+            else:
+                continue
 
-        except Exception as e:
-            return False
+        return True, None
 
-    return check_column_values
+    except Exception as e:
+        return False, "There was an error checking the required content"
@@ -0,0 +1,37 @@
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """Returns a module that is only loaded the first time one of its attributes is used.
+
+    Only works for pure Python packages, extension modules such as pyodbc are
+    imported eagerly.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named '{name}'")
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load(*modules):
+    """Finishes loading lazy modules in the calling thread.
+
+    LazyLoader is not thread safe before Python 3.12: threads touching a module while
+    another thread is loading it see it half initialized. Modules used by worker
+    threads are loaded with this before the threads start.
+    """
+
+    for module in modules:
+        # Any attribute access runs the deferred import
+        module.__name__
@@ -0,0 +1,112 @@
+import os
+import pathlib
+import time
+from datetime import datetime
+from config import local_spool
+
+
+class LocalSpool:
+    """The local folder FTP downloads land in, bounded by size and age"""
+
+    def __init__(
+        self,
+        root=local_spool["root"],
+        max_bytes=local_spool["max_bytes"],
+        max_age_days=local_spool["max_age_days"],
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+
+    def create_dir(self, customer_name):
+        """Create a local directory to store the downloaded files"""
+
+        datetime_now = datetime.now().strftime("%Y%m%d_%H%M%S")
+        local_dir = pathlib.Path(self.root) / customer_name / datetime_now
+        local_dir.mkdir(parents=True, exist_ok=True)
+        return local_dir
+
+    def folder_name(self, file_path):
+        """Returns the FTP folder a downloaded file came from, its first folder under the root"""
+
+        return pathlib.Path(os.path.relpath(file_path, self.root)).parts[0]
+
+    def _files(self):
+        """Returns the (mtime, size, path) of every file in the spool"""
+
+        files = []
+        for root, dirs, file_names in os.walk(self.root):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def usage(self):
+        files = self._files()
+        return {
+            "files": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "max_bytes": self.max_bytes,
+        }
+
+    def release(self, file_paths):
+        """Removes files that are no longer needed, archived ones for instance, and their empty folders"""
+
+        for file_path in file_paths:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+            self._prune(os.path.dirname(file_path))
+
+    def _prune(self, directory):
+        """Removes a folder and its parents, up to the root, while they are empty"""
+
+        root = os.path.abspath(self.root)
+        directory = os.path.abspath(directory)
+        while directory.startswith(root + os.sep):
+            # rmdir only succeeds on an empty folder, so a folder a download
+            # is writing to is never removed
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def evict(self, protected=()):
+        """Removes expired files, then the oldest ones while the spool is over its size limit.
+
+        Files in protected, the ones the journal still needs, are kept.
+        Returns the number of files and bytes removed.
+        """
+
+        protected = {os.path.abspath(path) for path in protected}
+        now = time.time()
+
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        evicted_files = 0
+        evicted_bytes = 0
+
+        for mtime, size, path in files:
+            expired = now - mtime > self.max_age_seconds
+            if not expired and total <= self.max_bytes:
+                continue
+            if os.path.abspath(path) in protected:
+                continue
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            self._prune(os.path.dirname(path))
+
+            total -= size
+            evicted_files += 1
+            evicted_bytes += size
+
+        return {"files": evicted_files, "bytes": evicted_bytes}
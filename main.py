@@ -1,17 +1,44 @@
 from email_helper import send_email
 from ftp import FTPManager
 from dropship_db import ExampleDb
+from folder_leases import FolderLeases
 from invalid_file_checker import InvalidFileChecker
+from order_spool import write_spool
+from profiler import StageProfiler
+from progress import counters, progress, set_quiet
+from run_journal import RunJournal
+from scheduler import Scheduler
 from xlsx_parser import XlsxParser
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import traceback
 import os
 
 
-def main():
+def main(profile=False, quiet=False):
+    if quiet:
+        set_quiet(True)
+
+    # Profiling is turned on with --profile or the DROPSHIP_PROFILE environment variable
+    profiler = StageProfiler(enabled=profile or bool(os.getenv("DROPSHIP_PROFILE")))
+
+    d_db = None
+    ftp = None
+    journal = None
+    leases = None
+
     try:
         d_db = ExampleDb()
         ftp = FTPManager()
+        journal = RunJournal()
+        leases = FolderLeases(d_db)
+
+        # Freeing the local spool before downloading, the files the journal still needs are kept
+        evicted = ftp.spool.evict(protected=journal.pending_paths())
+        if evicted["files"]:
+            print(
+                f"Evicted {evicted['files']} files, {evicted['bytes']} bytes, from the local spool"
+            )
 
         # Getting the dropshipper data
         dropshipper_data = d_db.load_dropship_data()
@@ -19,71 +46,157 @@ def main():
         excluded_shipping_states = d_db.load_excluded_shipping_states()
 
         parser = XlsxParser(dropshipper_data, d_db)
+        checker = InvalidFileChecker(d_db, parser)
 
         # Placeholders
         all_valid_files = {}
         all_invalid_files = {}
         all_order_objs = {}
+        files_to_parse = {}
+        files_to_register = []
         dropshipper_names = []
+        ftp_folder_names = {}
+        ftp_folder_names_by_name = {}
 
         for dropshipper in dropshipper_data.values():
-            dropshipper_id = dropshipper["id"]
-            dropshipper_name = dropshipper["name"]
-            dropshipper_names.append(dropshipper_name)
-            ftp_folder_name = dropshipper["ftp_folder_name"]
-            header_template = dropshipper["headers"]
+            dropshipper_names.append(dropshipper["name"])
+            ftp_folder_names[dropshipper["id"]] = dropshipper["ftp_folder_name"]
+            ftp_folder_names_by_name[dropshipper["name"]] = dropshipper[
+                "ftp_folder_name"
+            ]
 
-            # Downloading the files from the FTP server
-            new_orders_file_path = ftp.download_files(ftp_folder_name)
+        # Folders closest to their SLA go first, the ones with nothing waiting are skipped
+        scheduler = Scheduler(ftp)
+        dropshippers = scheduler.plan(
+            list(dropshipper_data.values()), journal, max_workers=d_db.pool.size
+        )
 
-            # If there are no new orders, skip to the next dropshipper
-            if not new_orders_file_path:
-                continue
-            elif not os.listdir(new_orders_file_path):
-                os.rmdir(new_orders_file_path)
-                continue
+        # The lazily imported modules can't be loaded by several threads at once
+        if dropshippers:
+            parser.load_dependencies()
+
+        # Independent dropshippers are processed concurrently, one DB connection each.
+        # They run serially while profiling since cProfile only sees one thread
+        max_workers = 1 if profiler.enabled else d_db.pool.size
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                lambda dropshipper: _process_dropshipper(
+                    dropshipper,
+                    ftp,
+                    journal,
+                    checker,
+                    parser,
+                    profiler,
+                    leases,
+                    scheduler,
+                ),
+                dropshippers,
+            )
+
+            for dropshipper, result in zip(dropshippers, results):
+                # If there are no new orders, skip to the next dropshipper
+                if not result:
+                    continue
+
+                dropshipper_id = dropshipper["id"]
+                files_to_register += result["files_to_register"]
+
+                # Adding the files to dictionaries using the dropshipper_id as the key
+                if result["files_to_parse"]:
+                    files_to_parse[dropshipper_id] = result["files_to_parse"]
+
+                if result["valid_files"]:
+                    all_valid_files[dropshipper_id] = result["valid_files"]
 
-            # Checking if the files are valid
-            checker = InvalidFileChecker(d_db, parser)
-            valid_files, invalid_files = checker.validate_files(
-                new_orders_file_path, header_template
+                if result["invalid_files"]:
+                    all_invalid_files[dropshipper["name"]] = result["invalid_files"]
+
+        scheduler.save()
+        ftp.breaker.save()
+        if ftp.breaker.skipped:
+            print(f"FTP folders skipped after repeated failures: {ftp.breaker.skipped}")
+        if scheduler.deferred:
+            print(
+                f"Run budget spent, deferred to the next run: {', '.join(scheduler.deferred)}"
             )
 
-            # Adding the files to dictionaries using the dropshipper_id as the key
-            if valid_files:
-                # NOTE: Turn off to not store the file names in the database to check for duplicates
-                for path in tqdm(
-                    valid_files, desc=f"Storing file names for {ftp_folder_name}"
-                ):
-                    file_name, pos = parser.data_extractor(
-                        path, dropshipper["po_header_name"]
-                    )
-                d_db.store_file_names(file_name, pos, dropshipper_id, path)
-                all_valid_files[dropshipper_id] = valid_files
-
-            if invalid_files:
-                all_invalid_files[dropshipper_name] = invalid_files
+        checker.print_rule_stats()
+
+        # Folders whose lease was lost are left to the worker that claimed them
+        files_to_register = [
+            file
+            for file in files_to_register
+            if leases.holds(ftp_folder_names[file["dropshipper_id"]])
+        ]
+
+        # NOTE: Turn off to not store the file names in the database to check for duplicates
+        with profiler.stage("store"):
+            failed_files = set(d_db.register_files(files_to_register))
+        for file in files_to_register:
+            if file["path"] not in failed_files:
+                journal.record(
+                    ftp_folder_names[file["dropshipper_id"]],
+                    [file["path"]],
+                    "registered",
+                )
 
         # Parsing the files
-        if all_valid_files:
-            po_objs, unparsed_skus = parser.file_parser(all_valid_files)
+        if files_to_parse:
+            with profiler.stage("parse"):
+                po_objs, unparsed_skus = parser.file_parser(files_to_parse)
             all_order_objs.update(po_objs)
 
+            for name, stats in parser.normalization_stats().items():
+                print(
+                    f"Normalizer {name}: {stats['rows']} rows, "
+                    f"{stats['distinct']} distinct ({stats['distinct_ratio']:.1%} formatted)"
+                )
+
+        # The dropshipper each order came from, its id may be replaced by the shipping check
+        order_origins = {
+            po_number: po_obj["dropshipper_id"]
+            for po_number, po_obj in all_order_objs.items()
+        }
+
         # Checking the allowed skus
-        all_order_objs = parser.check_allowed_skus(all_order_objs, dropshipper_data)
+        with profiler.stage("transform"):
+            all_order_objs, rejected_skus = parser.check_allowed_skus(
+                all_order_objs, dropshipper_data
+            )
+
+        # Sending an email with the skus the dropshippers are not allowed to order
+        if rejected_skus:
+            send_email(
+                "Orders With Not Allowed Skus",
+                f"Skus not allowed per dropshipper (purchase order, sku): {rejected_skus}",
+            )
 
         # If there are no new orders, skip the rest of the code
         if not all_order_objs:
+            files_to_parse = _held_files(leases, files_to_parse, ftp_folder_names)
+            all_valid_files = _held_files(leases, all_valid_files, ftp_folder_names)
+            all_invalid_files = _held_files(
+                leases, all_invalid_files, ftp_folder_names_by_name
+            )
+            _record_stored(journal, files_to_parse, ftp_folder_names)
             if all_valid_files:
-                ftp.moving_files(all_valid_files, "order_logs")
+                _archive(ftp, journal, profiler, all_valid_files, "order_logs")
             if all_invalid_files:
-                ftp.moving_files(all_invalid_files, "error_logs", remove_from_tmp=True)
+                _archive(
+                    ftp,
+                    journal,
+                    profiler,
+                    all_invalid_files,
+                    "error_logs",
+                    remove_from_tmp=True,
+                )
             return
 
         # Checking the shipping states
-        unable_to_ship, shipable_orders_objs = parser.check_shipping_states(
-            all_order_objs, excluded_shipping_states, international_accounts
-        )
+        with profiler.stage("transform"):
+            unable_to_ship, shipable_orders_objs = parser.check_shipping_states(
+                all_order_objs, excluded_shipping_states, international_accounts
+            )
 
         # Sending an email with the orders that can't be shipped
         if unable_to_ship:
@@ -92,11 +205,45 @@ def main():
                 f"Orders unable to ship: {unable_to_ship}",
             )
 
+        # Spooling the normalized orders so they can be replayed without re-parsing
+        if shipable_orders_objs:
+            try:
+                with profiler.stage("store"):
+                    write_spool(shipable_orders_objs)
+            except Exception as e:
+                print(f"Error while spooling the orders: {e}")
+
+        # Orders of folders whose lease was lost are left to the new owner
+        shipable_orders_objs = {
+            po_number: po_obj
+            for po_number, po_obj in shipable_orders_objs.items()
+            if leases.holds(ftp_folder_names[order_origins[po_number]])
+        }
+
         # NOTE: Turn off to not store the orders in the database
         if shipable_orders_objs:
-            if d_db.store_purchase_orders(shipable_orders_objs):
+            with profiler.stage("store"):
+                # Each dropshipper's files are journaled as stored right after its commit,
+                # so a failure of another dropshipper does not get them inserted again
+                stored = d_db.store_purchase_orders(
+                    shipable_orders_objs,
+                    origins=order_origins,
+                    on_stored=lambda dropshipper_id: journal.record(
+                        ftp_folder_names[dropshipper_id],
+                        files_to_parse.get(dropshipper_id, []),
+                        "stored",
+                    ),
+                    # Serial while profiling, cProfile only sees the calling thread
+                    max_workers=1 if profiler.enabled else None,
+                )
+
+            if stored:
+                files_to_parse = _held_files(leases, files_to_parse, ftp_folder_names)
+                all_valid_files = _held_files(leases, all_valid_files, ftp_folder_names)
+                _record_stored(journal, files_to_parse, ftp_folder_names)
+
                 # Moving the valid files to the order_logs folder
-                ftp.moving_files(all_valid_files, "order_logs")
+                _archive(ftp, journal, profiler, all_valid_files, "order_logs")
 
             else:
                 send_email(
@@ -104,15 +251,181 @@ def main():
                     "There was an error storing the orders in the database. Valid files were never moved from their FTP folders. Re-run the  dropship_order_import script to try again.",
                 )
         # Moving the invalid files to the error_logs folder
-        ftp.moving_files(all_invalid_files, "error_logs", remove_from_tmp=True)
-
-        d_db.close()
+        all_invalid_files = _held_files(
+            leases, all_invalid_files, ftp_folder_names_by_name
+        )
+        _archive(
+            ftp,
+            journal,
+            profiler,
+            all_invalid_files,
+            "error_logs",
+            remove_from_tmp=True,
+        )
 
     except Exception as e:
         print(f"There was an error: {e}")
         send_email("An Error Occurred", f"Error: {e}\n\n{traceback.format_exc()}")
         raise e
 
+    finally:
+        # Runs on every exit, including the early return of runs without new orders
+        if leases:
+            leases.close()
+        if journal:
+            journal.purge_archived()
+            journal.close()
+        if d_db:
+            d_db.close()
+
+        if counters:
+            print(f"Processed items: {dict(counters)}")
+
+        if ftp:
+            usage = ftp.spool.usage()
+            print(
+                f"Local spool: {usage['files']} files, "
+                f"{usage['bytes']} of {usage['max_bytes']} bytes"
+            )
+
+        profiler.write()
+
+
+def _process_dropshipper(
+    dropshipper, ftp, journal, checker, parser, profiler, leases, scheduler
+):
+    """Downloads and validates the files of a dropshipper and extracts their purchase order numbers"""
+
+    dropshipper_id = dropshipper["id"]
+    ftp_folder_name = dropshipper["ftp_folder_name"]
+    header_template = dropshipper["headers"]
+
+    # Folders not started within the run budget wait for the next run
+    if not scheduler.admit(ftp_folder_name):
+        return None
+
+    # Folders claimed by another worker are left to it
+    if not leases.claim(ftp_folder_name):
+        print(f"Skipping {ftp_folder_name}, it is leased by another worker")
+        return None
+
+    # Files left behind by an interrupted run resume from their last stage
+    pending = journal.pending(ftp_folder_name)
+
+    # Downloading the files from the FTP server
+    with profiler.stage("download"):
+        new_orders_file_path = ftp.download_files(ftp_folder_name, skip=set(pending))
+
+    new_files = []
+    if new_orders_file_path:
+        if os.listdir(new_orders_file_path):
+            new_files = [
+                os.path.join(new_orders_file_path, file)
+                for file in os.listdir(new_orders_file_path)
+            ]
+            journal.record(ftp_folder_name, new_files, "downloaded")
+        else:
+            os.rmdir(new_orders_file_path)
+
+    if not new_files and not pending:
+        return None
+
+    files_by_stage = {
+        stage: [] for stage in ["downloaded", "validated", "registered", "stored"]
+    }
+    invalid_files = []
+    for entry in pending.values():
+        if entry["invalid_reason"]:
+            invalid_files.append((entry["local_path"], entry["invalid_reason"]))
+        else:
+            files_by_stage[entry["stage"]].append(entry["local_path"])
+
+    # Checking if the files are valid
+    with profiler.stage("validate"):
+        valid_files, new_invalid_files = checker.validate_paths(
+            new_files + files_by_stage["downloaded"],
+            header_template,
+            desc=f"Checking for valid files in folder {ftp_folder_name}",
+        )
+    journal.record(ftp_folder_name, valid_files, "validated")
+    journal.record_invalid(ftp_folder_name, new_invalid_files)
+    invalid_files += new_invalid_files
+    valid_files += files_by_stage["validated"]
+
+    # Collecting the file names to register them for the whole run at once
+    files_to_register = []
+    with profiler.stage("validate"):
+        for path in progress(
+            valid_files, desc=f"Extracting file names for {ftp_folder_name}"
+        ):
+            extracted = parser.data_extractor(path, dropshipper["po_header_name"])
+            if not extracted:
+                continue
+
+            file_name, pos = extracted
+            files_to_register.append(
+                {
+                    "dropshipper_id": dropshipper_id,
+                    "file_name": file_name,
+                    "pos": pos,
+                    "path": path,
+                }
+            )
+
+    # Files already stored by a previous run are only archived
+    files_to_parse = valid_files + files_by_stage["registered"]
+
+    return {
+        "files_to_register": files_to_register,
+        "files_to_parse": files_to_parse,
+        "valid_files": files_to_parse + files_by_stage["stored"],
+        "invalid_files": invalid_files,
+    }
+
+
+def _held_files(leases, files, folder_names):
+    """Keeps the files of the folders this worker still holds the lease of"""
+
+    held = {}
+    for key, paths in files.items():
+        if leases.holds(folder_names[key]):
+            held[key] = paths
+        else:
+            print(f"Lease on {folder_names[key]} lost, leaving it to its new owner")
+    return held
+
+
+def _record_stored(journal, files_to_parse, ftp_folder_names):
+    """Records the parsed files as stored so a restart does not insert them again"""
+
+    for dropshipper_id, file_paths in files_to_parse.items():
+        journal.record(ftp_folder_names[dropshipper_id], file_paths, "stored")
+
+
+def _archive(ftp, journal, profiler, all_files, destination, remove_from_tmp=False):
+    """Moves the files in the FTP server, records the ones that were archived and removes their local copies"""
+
+    with profiler.stage("move"):
+        moved_files = ftp.moving_files(all_files, destination, remove_from_tmp)
+    for file_path in moved_files:
+        journal.record(ftp.spool.folder_name(file_path), [file_path], "archived")
+
+    # Archived files are no longer needed locally
+    ftp.spool.release(moved_files)
+
 
 if __name__ == "__main__":
-    main()
+    arg_parser = argparse.ArgumentParser(description="Import dropshipper orders")
+    arg_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Write per-stage CPU and memory profiles to the profiles folder",
+    )
+    arg_parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Replace the progress bars with item counters, also set with DROPSHIP_QUIET",
+    )
+    args = arg_parser.parse_args()
+
+    main(profile=args.profile, quiet=args.quiet)
@@ -0,0 +1,344 @@
+import argparse
+import re
+from datetime import datetime
+from dropship_db import ExampleDb
+
+# Indexes the intake queries rely on: (name, table, key columns, included columns, unique)
+INDEXES = [
+    (
+        "IX_PurchaseOrderFiles_file_name",
+        "PurchaseOrderFiles",
+        ("file_name",),
+        ("dropshipper_id",),
+        False,
+    ),
+    (
+        "IX_PurchaseOrders_purchase_order_number",
+        "PurchaseOrders",
+        ("purchase_order_number",),
+        (),
+        False,
+    ),
+    ("IX_States_code", "States", ("code",), ("country_id",), False),
+    ("UX_Countries_two_letter_code", "Countries", ("two_letter_code",), (), True),
+    ("UX_Dropshippers_code", "Dropshippers", ("code",), (), True),
+    (
+        "IX_DropshipperAllowedSkus_dropshipper_id",
+        "DropshipperAllowedSkus",
+        ("dropshipper_id",),
+        ("sku",),
+        False,
+    ),
+]
+
+
+def _create_index(name, table, columns, include=(), unique=False):
+    sql = (
+        f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} "
+        f"ON {table} ({', '.join(columns)})"
+    )
+    if include:
+        sql += f" INCLUDE ({', '.join(include)})"
+
+    # Tables missing from the database are skipped, verify reports their indexes
+    return f"""
+        IF OBJECT_ID('{table}', 'U') IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM sys.indexes
+            WHERE name = '{name}' AND object_id = OBJECT_ID('{table}')
+        )
+        {sql}
+        """
+
+
+def find_duplicates(d_db: ExampleDb):
+    """Returns the duplicated values, with their counts, of the columns getting a unique index"""
+
+    duplicates = {}
+    with d_db.pool.connection() as conn:
+        for name, table, columns, _, unique in INDEXES:
+            if not unique:
+                continue
+            if not conn.execute(f"SELECT OBJECT_ID('{table}', 'U')").fetchone()[0]:
+                continue
+
+            rows = conn.execute(
+                f"""
+                SELECT {', '.join(columns)}, COUNT(*) AS row_count
+                FROM {table}
+                GROUP BY {', '.join(columns)}
+                HAVING COUNT(*) > 1
+                """
+            ).fetchall()
+            if rows:
+                duplicates[name] = [(tuple(row)[:-1], row.row_count) for row in rows]
+
+    return duplicates
+
+
+# Applied in order, each version in its own transaction. Statements are guarded so
+# databases where the objects were created by hand can be migrated too
+MIGRATIONS = [
+    (
+        1,
+        "Indexes for the file, order, state, country, dropshipper and allowed sku lookups",
+        [
+            """
+            IF OBJECT_ID('DropshipperAllowedSkus', 'U') IS NULL
+            CREATE TABLE DropshipperAllowedSkus (
+                id INT IDENTITY(1, 1) NOT NULL PRIMARY KEY,
+                dropshipper_id INT NOT NULL,
+                sku NVARCHAR(100) NOT NULL
+            )
+            """,
+            *[_create_index(*index) for index in INDEXES],
+        ],
+    ),
+    (
+        2,
+        "Folder leases of the intake workers",
+        [
+            """
+            IF OBJECT_ID('FolderLeases', 'U') IS NULL
+            CREATE TABLE FolderLeases (
+                folder_name NVARCHAR(255) NOT NULL PRIMARY KEY,
+                worker_id NVARCHAR(255) NOT NULL,
+                expires_at DATETIME2 NOT NULL
+            )
+            """
+        ],
+    ),
+    (
+        3,
+        "Outbox of the stored order batches for downstream consumers",
+        [
+            """
+            IF OBJECT_ID('OrderOutbox', 'U') IS NULL
+            CREATE TABLE OrderOutbox (
+                id BIGINT IDENTITY(1, 1) NOT NULL PRIMARY KEY,
+                dropshipper_id INT NOT NULL,
+                order_count INT NOT NULL,
+                payload NVARCHAR(MAX) NOT NULL,
+                created_at DATETIME2 NOT NULL
+            )
+            """
+        ],
+    ),
+]
+
+# Hot lookups and sample parameters, their plans must seek an index
+HOT_QUERIES = {
+    "file name exists": (
+        "SELECT TOP 1 1 FROM PurchaseOrderFiles WHERE file_name = ?",
+        ("orders.csv",),
+    ),
+    "existing file names": (
+        "SELECT file_name FROM PurchaseOrderFiles WHERE file_name IN (?, ?)",
+        ("orders_1.csv", "orders_2.csv"),
+    ),
+    "purchase order exists": (
+        "SELECT TOP 1 1 FROM PurchaseOrders WHERE purchase_order_number = ?",
+        ("PO-1",),
+    ),
+    "existing purchase orders": (
+        "SELECT purchase_order_number FROM PurchaseOrders WHERE purchase_order_number IN (?, ?)",
+        ("PO-1", "PO-2"),
+    ),
+    "state id": ("SELECT id FROM States WHERE code = ?", ("TX",)),
+    "country id": ("SELECT id FROM Countries WHERE two_letter_code = ?", ("US",)),
+    "dropshipper id": ("SELECT id FROM Dropshippers WHERE code = ?", ("CODE",)),
+    "allowed skus": (
+        "SELECT dropshipper_id, sku FROM DropshipperAllowedSkus WHERE dropshipper_id = ?",
+        (1,),
+    ),
+    "outbox tail": (
+        "SELECT TOP (?) id, payload FROM OrderOutbox WHERE id > ? ORDER BY id",
+        (100, 0),
+    ),
+    "folder lease": (
+        "SELECT worker_id FROM FolderLeases WHERE folder_name = ?",
+        ("folder",),
+    ),
+}
+
+
+def current_version(d_db: ExampleDb):
+    """Returns the last migration applied, creating the version table on first use"""
+
+    with d_db.pool.connection() as conn:
+        conn.execute(
+            """
+            IF OBJECT_ID('SchemaVersions', 'U') IS NULL
+            CREATE TABLE SchemaVersions (
+                version INT NOT NULL PRIMARY KEY,
+                description NVARCHAR(255) NOT NULL,
+                applied_at DATETIME2 NOT NULL
+            )
+            """
+        )
+        conn.commit()
+
+        return (
+            conn.execute("SELECT MAX(version) FROM SchemaVersions").fetchone()[0] or 0
+        )
+
+
+def migrate(d_db: ExampleDb):
+    """Applies the pending migrations. Returns the versions applied"""
+
+    applied = []
+    version = current_version(d_db)
+
+    # A unique index can't be created over duplicated rows, they have to be fixed first
+    if version < 1:
+        duplicates = find_duplicates(d_db)
+        if duplicates:
+            for name, rows in duplicates.items():
+                print(f"Duplicated values blocking {name}: {rows}")
+            raise ValueError("Remove the duplicated rows before migrating")
+
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        try:
+            with d_db.pool.connection() as conn:
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(
+                    """
+                    INSERT INTO SchemaVersions (version, description, applied_at)
+                    VALUES (?, ?, ?)
+                    """,
+                    migration_version,
+                    description,
+                    datetime.now(),
+                )
+                conn.commit()
+
+        except Exception as e:
+            print(f"Error while applying migration {migration_version}: {e}")
+            raise
+
+        print(f"Applied migration {migration_version}: {description}")
+        applied.append(migration_version)
+
+    return applied
+
+
+def verify(d_db: ExampleDb):
+    """Checks the schema version and that every index exists with the expected columns. Returns the problems found"""
+
+    problems = []
+
+    version = current_version(d_db)
+    if version < MIGRATIONS[-1][0]:
+        problems.append(
+            f"Schema is at version {version}, the latest is {MIGRATIONS[-1][0]}"
+        )
+
+    for name, rows in find_duplicates(d_db).items():
+        problems.append(f"Duplicated values blocking {name}: {rows}")
+
+    with d_db.pool.connection() as conn:
+        for name, table, columns, include, unique in INDEXES:
+            rows = conn.execute(
+                """
+                SELECT i.is_unique, c.name AS column_name, ic.is_included_column
+                FROM sys.indexes i
+                JOIN sys.index_columns ic
+                    ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+                JOIN sys.columns c
+                    ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+                WHERE i.name = ? AND i.object_id = OBJECT_ID(?)
+                ORDER BY ic.key_ordinal
+                """,
+                name,
+                table,
+            ).fetchall()
+
+            if not rows:
+                problems.append(f"Index {name} is missing on {table}")
+                continue
+
+            key_columns = tuple(
+                row.column_name for row in rows if not row.is_included_column
+            )
+            included_columns = {
+                row.column_name for row in rows if row.is_included_column
+            }
+            if key_columns != tuple(columns):
+                problems.append(f"Index {name} is on {key_columns}, expected {columns}")
+            if not set(include) <= included_columns:
+                problems.append(
+                    f"Index {name} does not include {sorted(set(include) - included_columns)}"
+                )
+            if bool(rows[0].is_unique) != unique:
+                problems.append(
+                    f"Index {name} should {'' if unique else 'not '}be unique"
+                )
+
+    return problems
+
+
+def explain(d_db: ExampleDb):
+    """Returns the physical operators of the plan of every hot query and whether it seeks an index"""
+
+    plans = {}
+
+    with d_db.pool.connection() as conn:
+        # SHOWPLAN changes what every statement of the session returns until turned off
+        cursor = conn.cursor
+        try:
+            cursor.execute("SET SHOWPLAN_XML ON")
+            for name, (sql, params) in HOT_QUERIES.items():
+                plan = cursor.execute(sql, *params).fetchone()[0]
+                operators = re.findall(r'PhysicalOp="([^"]+)"', plan)
+                plans[name] = {
+                    "operators": operators,
+                    "seeks": any(operator.endswith("Seek") for operator in operators)
+                    and not any(operator.endswith("Scan") for operator in operators),
+                }
+        finally:
+            cursor.execute("SET SHOWPLAN_XML OFF")
+
+    return plans
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        description="Manage the schema and indexes of the intake tables"
+    )
+    arg_parser.add_argument(
+        "command",
+        choices=["migrate", "verify", "explain"],
+        help="Apply the pending migrations, check the indexes, or check the query plans",
+    )
+    args = arg_parser.parse_args()
+
+    d_db = ExampleDb()
+    try:
+        if args.command == "migrate":
+            applied = migrate(d_db)
+            print(f"Schema is at version {current_version(d_db)}")
+            if not applied:
+                print("No pending migrations")
+
+        elif args.command == "verify":
+            problems = verify(d_db)
+            for problem in problems:
+                print(problem)
+            if not problems:
+                print("Schema and indexes are up to date")
+            raise SystemExit(1 if problems else 0)
+
+        else:
+            plans = explain(d_db)
+            for name, plan in plans.items():
+                print(
+                    f"{name}: {'index seek' if plan['seeks'] else 'NO INDEX SEEK'} "
+                    f"({', '.join(plan['operators'])})"
+                )
+            raise SystemExit(0 if all(plan["seeks"] for plan in plans.values()) else 1)
+
+    finally:
+        d_db.close()
@@ -0,0 +1,28 @@
+class MemoizedNormalizer:
+    """Applies a formatting function once per distinct raw value of a column"""
+
+    def __init__(self, func):
+        self.func = func
+        self.rows = 0
+        self.distinct = 0
+
+    def __call__(self, value):
+        return self.func(value)
+
+    def apply(self, series):
+        """Formats the distinct values of the series and maps them back to every row"""
+
+        uniques = series.unique()
+        self.rows += len(series)
+        self.distinct += len(uniques)
+
+        mapping = {value: self.func(value) for value in uniques}
+        return series.map(mapping)
+
+    def stats(self):
+        return {
+            "rows": self.rows,
+            "distinct": self.distinct,
+            # Share of rows the formatting function ran for, once per distinct value
+            "distinct_ratio": self.distinct / self.rows if self.rows else 0.0,
+        }
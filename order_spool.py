@@ -0,0 +1,164 @@
+import argparse
+import glob
+import os
+from datetime import datetime
+from config import SPOOL_DIR
+from dropship_db import ExampleDb
+
+ORDER_COLUMNS = [
+    "purchase_order_number",
+    "purchase_order_date",
+    "customer_first_name",
+    "customer_last_name",
+    "address",
+    "city",
+    "country",
+    "state",
+    "zip",
+    "phone",
+]
+
+
+def _schemas():
+    """Returns the order and item schemas. pyarrow is only imported when spooling"""
+
+    import pyarrow as pa
+
+    order_schema = pa.schema(
+        [(column, pa.string()) for column in ORDER_COLUMNS]
+        + [("dropshipper_id", pa.int64())]
+    )
+    item_schema = pa.schema(
+        [
+            ("purchase_order_number", pa.string()),
+            ("sku", pa.string()),
+            ("quantity", pa.int64()),
+        ]
+    )
+    return order_schema, item_schema
+
+
+def _to_str(value):
+    return None if value is None else str(value)
+
+
+def _partition_dir(spool_dir, date, dropshipper_id):
+    return os.path.join(spool_dir, f"date={date}", f"dropshipper_id={dropshipper_id}")
+
+
+def write_spool(po_objs, spool_dir=SPOOL_DIR, run_id=None):
+    """Writes the normalized orders and items to Parquet, partitioned by date and dropshipper"""
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    order_schema, item_schema = _schemas()
+
+    now = datetime.now()
+    run_id = run_id or now.strftime("%Y%m%d_%H%M%S")
+    date = now.strftime("%Y-%m-%d")
+
+    orders_by_dropshipper = {}
+    for po_obj in po_objs.values():
+        orders_by_dropshipper.setdefault(int(po_obj["dropshipper_id"]), []).append(
+            po_obj
+        )
+
+    written = []
+    for dropshipper_id, orders in orders_by_dropshipper.items():
+        order_columns = {
+            column: [_to_str(po_obj[column]) for po_obj in orders]
+            for column in ORDER_COLUMNS
+        }
+        order_columns["dropshipper_id"] = [dropshipper_id] * len(orders)
+
+        items = [
+            (str(po_obj["purchase_order_number"]), sku, int(quantity))
+            for po_obj in orders
+            for sku, quantity in po_obj["items"].items()
+        ]
+        item_columns = {
+            "purchase_order_number": [item[0] for item in items],
+            "sku": [item[1] for item in items],
+            "quantity": [item[2] for item in items],
+        }
+
+        partition_dir = _partition_dir(spool_dir, date, dropshipper_id)
+        os.makedirs(partition_dir, exist_ok=True)
+
+        for name, columns, schema in [
+            ("orders", order_columns, order_schema),
+            ("items", item_columns, item_schema),
+        ]:
+            path = os.path.join(partition_dir, f"{name}-{run_id}.parquet")
+            # Written under a temporary name so a replay never reads a partial file
+            pq.write_table(
+                pa.Table.from_pydict(columns, schema=schema),
+                f"{path}.tmp",
+                compression="zstd",
+            )
+            os.replace(f"{path}.tmp", path)
+            written.append(path)
+
+    return written
+
+
+def read_spool(spool_dir=SPOOL_DIR, date=None, dropshipper_id=None):
+    """Rebuilds the purchase order objects from the spool"""
+
+    import pyarrow.parquet as pq
+
+    partition_dir = _partition_dir(
+        spool_dir, date or "*", dropshipper_id if dropshipper_id is not None else "*"
+    )
+
+    po_objs = {}
+    for orders_path in sorted(
+        glob.glob(os.path.join(partition_dir, "orders-*.parquet"))
+    ):
+        items_path = orders_path.replace(f"{os.sep}orders-", f"{os.sep}items-")
+
+        for order in pq.read_table(orders_path).to_pylist():
+            order["items"] = {}
+            po_objs[order["purchase_order_number"]] = order
+
+        for item in pq.read_table(items_path).to_pylist():
+            po_objs[item["purchase_order_number"]]["items"][item["sku"]] = item[
+                "quantity"
+            ]
+
+    return po_objs
+
+
+def replay(date=None, dropshipper_id=None, spool_dir=SPOOL_DIR):
+    """Loads spooled orders straight into the database, skipping the ones already stored"""
+
+    po_objs = read_spool(spool_dir, date, dropshipper_id)
+    if not po_objs:
+        print("There are no spooled orders to replay")
+        return
+
+    d_db = ExampleDb()
+    try:
+        existing = d_db.get_existing_purchase_orders(list(po_objs))
+        po_objs = {
+            po_number: po_obj
+            for po_number, po_obj in po_objs.items()
+            if po_number not in existing
+        }
+        print(f"Replaying {len(po_objs)} orders, {len(existing)} were already stored")
+
+        if po_objs:
+            d_db.store_purchase_orders(po_objs)
+    finally:
+        d_db.close()
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Replay spooled orders")
+    arg_parser.add_argument("--date", help="Partition date, YYYY-MM-DD")
+    arg_parser.add_argument("--dropshipper-id", type=int)
+    arg_parser.add_argument("--spool-dir", default=SPOOL_DIR)
+    args = arg_parser.parse_args()
+
+    replay(args.date, args.dropshipper_id, args.spool_dir)
@@ -0,0 +1,104 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from config import PROFILE_DIR
+
+
+class StageProfiler:
+    """Per-stage CPU profiles, wall time and tracemalloc peaks written to a per-run directory.
+
+    cProfile only sees the thread that enables it, so callers run the stages
+    serially while profiling is enabled.
+    """
+
+    def __init__(self, enabled=False, profile_dir=PROFILE_DIR, top_allocations=10):
+        self.enabled = enabled
+        self.run_dir = os.path.join(
+            profile_dir, datetime.now().strftime("%Y%m%d_%H%M%S")
+        )
+        self.top_allocations = top_allocations
+        self._profiles = {}
+        self._summary = {}
+
+        if self.enabled:
+            tracemalloc.start(25)
+
+    @contextmanager
+    def stage(self, name):
+        """Profiles the with block, accumulating repeated runs of the same stage"""
+
+        if not self.enabled:
+            yield
+            return
+
+        profile = self._profiles.setdefault(name, cProfile.Profile())
+        summary = self._summary.setdefault(
+            name,
+            {"calls": 0, "wall_time": 0.0, "peak_memory": 0, "top_allocations": []},
+        )
+
+        tracemalloc.reset_peak()
+        before = self._snapshot()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            summary["calls"] += 1
+            summary["wall_time"] += time.perf_counter() - start
+
+            _, peak = tracemalloc.get_traced_memory()
+            if peak >= summary["peak_memory"]:
+                summary["peak_memory"] = peak
+                # The allocation sites are kept for the run with the highest peak
+                after = self._snapshot()
+                summary["top_allocations"] = [
+                    {
+                        "site": str(stat.traceback[0]),
+                        "size_diff": stat.size_diff,
+                        "count_diff": stat.count_diff,
+                    }
+                    for stat in after.compare_to(before, "lineno")[
+                        : self.top_allocations
+                    ]
+                ]
+
+    def _snapshot(self):
+        # The profiler's own allocations are left out of the allocation sites
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+    def write(self):
+        """Writes a pstats file and a text report per stage, plus a JSON summary"""
+
+        if not self.enabled:
+            return
+
+        try:
+            os.makedirs(self.run_dir, exist_ok=True)
+
+            for name, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(self.run_dir, f"{name}.pstats"))
+
+                report = io.StringIO()
+                pstats.Stats(profile, stream=report).sort_stats(
+                    "cumulative"
+                ).print_stats(30)
+                with open(os.path.join(self.run_dir, f"{name}.txt"), "w") as file:
+                    file.write(report.getvalue())
+
+            with open(os.path.join(self.run_dir, "summary.json"), "w") as file:
+                json.dump(self._summary, file, indent=2)
+
+            print(f"Profiles written to {self.run_dir}")
+
+        except Exception as e:
+            print(f"Error writing the profiles: {e}")
@@ -0,0 +1,33 @@
+import os
+from collections import Counter
+
+# Headless runs replace the tqdm progress bars with plain item counters
+quiet = bool(os.getenv("DROPSHIP_QUIET"))
+counters = Counter()
+
+
+def set_quiet(value):
+    global quiet
+    quiet = value
+
+
+def progress(iterable, desc=None):
+    """Wraps an iterable in a tqdm progress bar, or counts its items in quiet mode"""
+
+    if not quiet:
+        from tqdm import tqdm
+
+        return tqdm(iterable, desc=desc)
+
+    # Sized iterables are counted up front so iterating them costs nothing extra
+    if hasattr(iterable, "__len__"):
+        counters[desc] += len(iterable)
+        return iterable
+
+    return _counted(iterable, desc)
+
+
+def _counted(iterable, desc):
+    for item in iterable:
+        counters[desc] += 1
+        yield item
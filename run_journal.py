@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+import os
+from datetime import datetime
+from config import JOURNAL_PATH
+
+# Stages a file goes through, in order
+STAGES = ["downloaded", "validated", "registered", "stored", "archived"]
+
+
+class RunJournal:
+    """Durable local record of each file's progress so a crashed run can resume"""
+
+    def __init__(self, path=JOURNAL_PATH):
+        try:
+            self.conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None
+            )
+            # WAL keeps every committed stage on disk without blocking readers
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=FULL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    folder TEXT NOT NULL,
+                    file_name TEXT NOT NULL,
+                    local_path TEXT,
+                    stage TEXT NOT NULL,
+                    invalid_reason TEXT,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (folder, file_name)
+                )
+                """
+            )
+            self.lock = threading.Lock()
+        except sqlite3.Error as e:
+            print(f"Error opening the run journal: {e}")
+            raise
+
+    def record(self, folder, file_paths, stage, invalid_reason=None):
+        """Records that the files reached a stage in a single transaction"""
+
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = [
+            (folder, file_path.split("\\")[-1], file_path, stage, invalid_reason, now)
+            for file_path in file_paths
+        ]
+        if not rows:
+            return
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany(
+                    """
+                    INSERT INTO files (folder, file_name, local_path, stage, invalid_reason, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (folder, file_name) DO UPDATE SET
+                        local_path = excluded.local_path,
+                        stage = excluded.stage,
+                        invalid_reason = excluded.invalid_reason,
+                        updated_at = excluded.updated_at
+                    """,
+                    rows,
+                )
+                self.conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self.conn.execute("ROLLBACK")
+                print(f"Error while recording files in the run journal: {e}")
+                raise
+
+    def record_invalid(self, folder, invalid_files):
+        """Records the invalid files with the reason they failed validation"""
+
+        for file_path, reason in invalid_files:
+            self.record(folder, [file_path], "validated", invalid_reason=reason)
+
+    def pending(self, folder):
+        """Returns the files of a folder that were not archived and are still on disk"""
+
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT file_name, local_path, stage, invalid_reason FROM files
+                WHERE folder = ? AND stage != 'archived'
+                """,
+                (folder,),
+            ).fetchall()
+
+        return {
+            file_name: {
+                "local_path": local_path,
+                "stage": stage,
+                "invalid_reason": invalid_reason,
+            }
+            for file_name, local_path, stage, invalid_reason in rows
+            if local_path and os.path.exists(local_path)
+        }
+
+    def pending_paths(self):
+        """Returns the local paths of every file that was not archived yet"""
+
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT local_path FROM files
+                WHERE stage != 'archived' AND local_path IS NOT NULL
+                """
+            ).fetchall()
+
+        return {local_path for (local_path,) in rows}
+
+    def stages(self, folder):
+        """Returns the stage and invalid reason of every file recorded for a folder"""
+
+        with self.lock:
+            rows = self.conn.execute(
+                """
+                SELECT file_name, stage, invalid_reason FROM files
+                WHERE folder = ?
+                """,
+                (folder,),
+            ).fetchall()
+
+        return {
+            file_name: (stage, invalid_reason)
+            for file_name, stage, invalid_reason in rows
+        }
+
+    def purge_archived(self):
+        """Removes the archived files from the journal"""
+
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE stage = 'archived'")
+
+    def close(self):
+        self.conn.close()
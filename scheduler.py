@@ -0,0 +1,143 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from config import schedule
+
+
+class Scheduler:
+    """Orders the dropshipper folders by SLA slack, priority and backlog, within a per-run time budget"""
+
+    def __init__(
+        self,
+        ftp,
+        budget_seconds=schedule["run_budget_seconds"],
+        state_path=schedule["state_path"],
+    ):
+        self.ftp = ftp
+        self.budget_seconds = budget_seconds
+        self.state_path = state_path
+        self.started = time.monotonic()
+        self.backlogs = {}
+        self.deferred = []
+        self._lock = threading.Lock()
+        self._state = self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {"deferred": {}}
+
+    def _probe(self, ftp_folder_name):
+        """Returns the number of waiting files, their size and the age in minutes of the oldest one"""
+
+        try:
+            files = self.ftp.list_files(f"dropshipper/{ftp_folder_name}/orders")
+        except Exception as e:
+            print(f"Error probing the backlog of {ftp_folder_name}: {e}")
+            return None
+
+        if not files:
+            return {"files": 0, "bytes": 0, "oldest_minutes": 0.0}
+
+        # MLSD and MDTM times are UTC
+        oldest = min(modified for _, _, modified in files)
+        return {
+            "files": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "oldest_minutes": (
+                datetime.now(timezone.utc).replace(tzinfo=None) - oldest
+            ).total_seconds()
+            / 60,
+        }
+
+    def plan(self, dropshippers, journal, max_workers=4):
+        """Probes the folders and returns the dropshippers in the order they should be processed.
+
+        Folders without waiting files, on the server or in the journal, and folders
+        whose circuit breaker is open are left out.
+        """
+
+        dropshippers = [
+            dropshipper
+            for dropshipper in dropshippers
+            if self.ftp.breaker.allow(dropshipper["ftp_folder_name"])
+        ]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            backlogs = executor.map(
+                lambda dropshipper: self._probe(dropshipper["ftp_folder_name"]),
+                dropshippers,
+            )
+            self.backlogs = {
+                dropshipper["ftp_folder_name"]: backlog
+                for dropshipper, backlog in zip(dropshippers, backlogs)
+            }
+
+        planned = []
+        for dropshipper in dropshippers:
+            ftp_folder_name = dropshipper["ftp_folder_name"]
+            backlog = self.backlogs[ftp_folder_name]
+            if (
+                backlog is not None
+                and not backlog["files"]
+                and not journal.pending(ftp_folder_name)
+            ):
+                continue
+            planned.append(dropshipper)
+
+        return sorted(planned, key=self._sort_key)
+
+    def _sort_key(self, dropshipper):
+        ftp_folder_name = dropshipper["ftp_folder_name"]
+        backlog = self.backlogs.get(ftp_folder_name)
+        deferrals = self._state["deferred"].get(ftp_folder_name, {}).get("count", 0)
+        sla = schedule["sla_minutes"].get(
+            ftp_folder_name, schedule["default_sla_minutes"]
+        )
+
+        # Folders that could not be probed are handled after the probed ones
+        if backlog is None:
+            return (1, -deferrals, 0, 0, 0)
+
+        return (
+            0,
+            -deferrals,
+            sla - backlog["oldest_minutes"],
+            -schedule["priorities"].get(ftp_folder_name, 0),
+            # Smaller backlogs first, so a large one does not hold the others back
+            backlog["bytes"],
+        )
+
+    def admit(self, ftp_folder_name):
+        """Returns False, and defers the folder to the next run, once the run budget is spent"""
+
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            if elapsed < self.budget_seconds:
+                self._state["deferred"].pop(ftp_folder_name, None)
+                return True
+
+            self.deferred.append(ftp_folder_name)
+            deferral = self._state["deferred"].setdefault(
+                ftp_folder_name, {"count": 0, "since": datetime.now().isoformat()}
+            )
+            deferral["count"] += 1
+            return False
+
+    def save(self):
+        """Persists the deferred folders so they go first on the next run"""
+
+        try:
+            os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w") as file:
+                json.dump(self._state, file, indent=2)
+            os.replace(tmp_path, self.state_path)
+
+        except Exception as e:
+            print(f"Error saving the schedule state: {e}")
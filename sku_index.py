@@ -0,0 +1,98 @@
+import os
+import pickle
+from config import SKU_INDEX_CACHE
+
+# Bumped whenever SkuIndex changes so cached indexes are rebuilt
+INDEX_VERSION = 2
+
+
+class SkuIndex:
+    """In-memory allow-list of a dropshipper's SKUs with alias and prefix handling"""
+
+    def __init__(self, skus):
+        self.exact = set()
+        self.prefixes = set()
+
+        for sku in skus:
+            sku = sku.strip().upper()
+            # Catalog entries ending in * allow every SKU starting with them
+            if sku.endswith("*"):
+                self.prefixes.add(sku[:-1])
+                continue
+
+            # Only the order SKUs are cleaned, cleaning the catalog would allow the
+            # stripped forms of its entries ("SHIRT" would allow "HIRT")
+            self.exact.add(sku)
+
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.prefixes})
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefixes)
+
+    def _has_prefix(self, sku):
+        return any(sku[:length] in self.prefixes for length in self.prefix_lengths)
+
+    def allowed_mask(self, skus, sku_cleaner):
+        """Returns a boolean Series telling which of the SKUs are allowed"""
+
+        normalized = skus.str.upper()
+        allowed = normalized.isin(self.exact)
+
+        # Only the distinct SKUs that missed the exact match are cleaned and prefix checked
+        remaining = normalized[~allowed].unique()
+        if len(remaining):
+            alias_allowed = {
+                sku: (sku_cleaner(sku) in self.exact) or self._has_prefix(sku)
+                for sku in remaining
+            }
+            allowed = allowed | normalized.map(alias_allowed).fillna(False).astype(bool)
+
+        return allowed
+
+
+def load_sku_indexes(d_db, cache_path=SKU_INDEX_CACHE):
+    """Returns the SKU index of every dropshipper with an allow-list, reloading only the ones that changed"""
+
+    cache = {}
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                cached = pickle.load(cache_file)
+            # Caches written by another version of the index are rebuilt
+            if cached.get("version") == INDEX_VERSION:
+                cache = cached["indexes"]
+        except Exception as e:
+            print(f"Error reading the SKU index cache: {e}")
+
+    fingerprints = d_db.get_allowed_skus_fingerprints()
+    stale = [
+        dropshipper_id
+        for dropshipper_id, fingerprint in fingerprints.items()
+        if dropshipper_id not in cache or cache[dropshipper_id][0] != fingerprint
+    ]
+
+    if stale:
+        for dropshipper_id, skus in d_db.load_allowed_skus(stale).items():
+            cache[dropshipper_id] = (
+                fingerprints[dropshipper_id],
+                SkuIndex(skus),
+            )
+
+    # Dropshippers whose allow-list was removed are dropped from the cache
+    removed = set(cache) - set(fingerprints)
+    cache = {
+        dropshipper_id: entry
+        for dropshipper_id, entry in cache.items()
+        if dropshipper_id in fingerprints
+    }
+
+    if stale or removed:
+        try:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            with open(f"{cache_path}.tmp", "wb") as cache_file:
+                pickle.dump({"version": INDEX_VERSION, "indexes": cache}, cache_file)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except Exception as e:
+            print(f"Error writing the SKU index cache: {e}")
+
+    return {dropshipper_id: entry[1] for dropshipper_id, entry in cache.items()}
@@ -0,0 +1,154 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import pyodbc
+
+from dropship_db import ExampleDb
+from folder_leases import FolderLeases
+
+sqlite3.register_adapter(datetime, datetime.isoformat)
+
+
+class SqliteConnection:
+    """Stand-in for a pooled connection, running the lease queries on SQLite"""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+    def execute(self, sql, *params):
+        try:
+            return self.conn.execute(sql, params)
+        except sqlite3.IntegrityError as e:
+            raise pyodbc.IntegrityError(str(e)) from e
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+class SqlitePool:
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def connection(self):
+        conn = SqliteConnection(self.path)
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def shared_db(tmp_path):
+    """An ExampleDb whose lease queries run on a SQLite file shared by every worker"""
+
+    path = str(tmp_path / "leases.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        """
+        CREATE TABLE FolderLeases (
+            folder_name TEXT NOT NULL PRIMARY KEY,
+            worker_id TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        )
+        """
+    )
+    conn.commit()
+    conn.close()
+
+    d_db = ExampleDb.__new__(ExampleDb)
+    d_db.pool = SqlitePool(path)
+    return d_db
+
+
+def test_workers_claim_disjoint_shards(tmp_path):
+    d_db = shared_db(tmp_path)
+    folders = [f"folder_{i}" for i in range(20)]
+    workers = [FolderLeases(d_db, worker_id=f"worker_{i}") for i in range(4)]
+    claimed = {worker.worker_id: [] for worker in workers}
+
+    def run(worker):
+        for folder in folders:
+            if worker.claim(folder):
+                claimed[worker.worker_id].append(folder)
+
+    threads = [threading.Thread(target=run, args=(worker,)) for worker in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    all_claimed = [folder for shard in claimed.values() for folder in shard]
+    assert sorted(all_claimed) == sorted(folders)
+
+    for worker in workers:
+        worker.close()
+
+
+def test_dead_worker_is_taken_over_after_expiry(tmp_path):
+    d_db = shared_db(tmp_path)
+    # The heartbeat never runs before the lease expires, as if the worker died
+    dead = FolderLeases(d_db, worker_id="dead", ttl_seconds=1, heartbeat_seconds=60)
+    alive = FolderLeases(d_db, worker_id="alive", ttl_seconds=1, heartbeat_seconds=60)
+
+    assert dead.claim("folder")
+    assert not alive.claim("folder")
+
+    time.sleep(1.2)
+    assert alive.claim("folder")
+
+    alive.close()
+
+
+def test_heartbeat_notices_a_lost_lease(tmp_path):
+    d_db = shared_db(tmp_path)
+    slow = FolderLeases(d_db, worker_id="slow", ttl_seconds=1, heartbeat_seconds=1.5)
+    other = FolderLeases(d_db, worker_id="other", ttl_seconds=10, heartbeat_seconds=60)
+
+    assert slow.claim("folder")
+    time.sleep(1.2)
+    assert other.claim("folder")
+
+    time.sleep(0.6)
+    assert not slow.holds("folder")
+    assert other.holds("folder")
+
+    slow.close()
+    other.close()
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    d_db = shared_db(tmp_path)
+    owner = FolderLeases(d_db, worker_id="owner", ttl_seconds=1, heartbeat_seconds=0.3)
+    other = FolderLeases(d_db, worker_id="other", ttl_seconds=1, heartbeat_seconds=60)
+
+    assert owner.claim("folder")
+    time.sleep(1.5)
+    assert not other.claim("folder")
+    assert owner.holds("folder")
+
+    owner.close()
+    other.close()
+
+
+def test_close_releases_the_folders(tmp_path):
+    d_db = shared_db(tmp_path)
+    first = FolderLeases(d_db, worker_id="first")
+    second = FolderLeases(d_db, worker_id="second")
+
+    assert first.claim("folder")
+    first.close()
+    assert second.claim("folder")
+
+    second.close()
@@ -1,18 +1,61 @@
-import pandas as pd
-import numpy as np
+from __future__ import annotations
+from compressed_files import inner_name, open_order_file
 from datetime import datetime
+from lazy_imports import lazy_import, load
 from dropship_db import ExampleDb
-from tqdm import tqdm
+from normalizer import MemoizedNormalizer
+from sku_index import load_sku_indexes
+from progress import progress
 import re
 
+# pandas and numpy are only loaded once a file is actually parsed
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+openpyxl = lazy_import("openpyxl")
+
+EXCEL_EXTENSIONS = (".xlsx", ".xlsm")
+
+# Rows of a workbook converted to string columns at a time
+XLSX_CHUNK_ROWS = 10000
+
+# Columns with few distinct values, stored as categoricals when the files are assembled
+CATEGORICAL_COLUMNS = ("city", "state", "country")
+
 
 class XlsxParser:
     def __init__(self, dropshipper_data, d_db: ExampleDb):
         self.dropshipper_data = dropshipper_data
         self.d_db = d_db
         self.headder_maps = self.d_db.get_header_maps()
+
+        # Reverse index from a header variant to its normalized name and its priority
+        # among that name's variants. The first normalized name claiming a variant wins
+        self._header_index = {}
+        for standard_name, variant_names in self.headder_maps.items():
+            for priority, variant_name in enumerate(variant_names):
+                self._header_index.setdefault(variant_name, (standard_name, priority))
+
+        # Rename plans compiled per exact header tuple
+        self._rename_plans = {}
         self.country_and_states = self.d_db.get_country_and_states()
 
+        # Order files repeat the same values once per sku line, so each column is
+        # formatted once per distinct value
+        self.normalizers = {
+            "city": MemoizedNormalizer(self._text_formater),
+            "zip": MemoizedNormalizer(self._zip_formater),
+            "name": MemoizedNormalizer(str.title),
+            "country_and_state": MemoizedNormalizer(
+                lambda pair: self._country_and_state_formater(*pair)
+            ),
+            "phone": MemoizedNormalizer(self._phone_formater),
+        }
+
+    def load_dependencies(self):
+        """Loads pandas, numpy and openpyxl before worker threads start using the parser"""
+
+        load(pd, np, openpyxl)
+
     def check_shipping_states(
         self, all_po_objs, excluded_shipping_states, international_accounts
     ):
@@ -20,7 +63,7 @@ class XlsxParser:
         try:
             shipable_orders_objs = {}
             unable_to_ship = {}
-            for po_number, po_obj in tqdm(
+            for po_number, po_obj in progress(
                 all_po_objs.items(), desc="Checking shipping states"
             ):
                 if po_obj["state"] not in excluded_shipping_states:
@@ -38,86 +81,197 @@ class XlsxParser:
             print(f"Error checking shipping states: {e}")
             raise
 
+    def check_allowed_skus(self, all_po_objs, dropshipper_data):
+        """This function removes the items whose sku is not in the dropshipper's allowed skus"""
+        try:
+            if not all_po_objs:
+                return all_po_objs, {}
+
+            sku_indexes = load_sku_indexes(self.d_db)
+
+            items = pd.DataFrame(
+                [
+                    (po_number, po_obj["dropshipper_id"], sku)
+                    for po_number, po_obj in all_po_objs.items()
+                    for sku in po_obj["items"]
+                ],
+                columns=["purchase_order_number", "dropshipper_id", "sku"],
+            )
+
+            # Dropshippers without an allow-list can order any sku
+            allowed = pd.Series(True, index=items.index)
+            for dropshipper_id, group in items.groupby("dropshipper_id"):
+                if dropshipper_id in sku_indexes:
+                    allowed[group.index] = sku_indexes[dropshipper_id].allowed_mask(
+                        group["sku"], self._sku_cleaner
+                    )
+
+            dropshipper_names = {
+                data["id"]: data["name"] for data in dropshipper_data.values()
+            }
+            rejected_skus = {}
+            for row in items[~allowed].itertuples():
+                dropshipper_name = dropshipper_names.get(
+                    row.dropshipper_id, row.dropshipper_id
+                )
+                rejected_skus.setdefault(dropshipper_name, []).append(
+                    (row.purchase_order_number, row.sku)
+                )
+                del all_po_objs[row.purchase_order_number]["items"][row.sku]
+
+            # Orders left without any allowed item are dropped
+            allowed_po_objs = {
+                po_number: po_obj
+                for po_number, po_obj in all_po_objs.items()
+                if po_obj["items"]
+            }
+
+            return allowed_po_objs, rejected_skus
+
+        except Exception as e:
+            print(f"Error checking allowed skus: {e}")
+            raise
+
     def file_parser(self, valid_files):
         """This function parses the files and returns a list of purchase order objects"""
-        dfs = []
+        frames = []
         for dropshipper_id, file_paths in valid_files.items():
             for file_path in file_paths:
                 df = self._df_reader(file_path)
                 # Removing whitespaces from the column names
                 df.columns = [col.replace(" ", "") for col in df.columns]
-                df = df.dropna(how="all").fillna("")
-                # Adding the dropshipper_id column to the dataframe
-                df.loc[:, "dropshipper_id"] = np.nan
-                # Updating the dropshipper_id column to the value for rows where the column is not empty
-                df.loc[df.notna().any(axis=1), "dropshipper_id"] = dropshipper_id
-                dfs.append(self.standardize_columns(df))
-
-        # Concatenating all the dataframes into one
-        df = pd.concat(dfs, ignore_index=True)
+                df = df.dropna(how="all")
+                frames.append((dropshipper_id, self.standardize_columns(df)))
+
+        if not frames:
+            return {}, {}
+
+        return self._parse(self._assemble_frames(frames))
+
+    def _assemble_frames(self, frames):
+        """This function builds one dataframe column by column from the (dropshipper_id, dataframe) pairs of every file.
+
+        Each column is concatenated once in the dtype the readers gave it, instead of
+        concatenating the whole frames and filling the missing values on another copy
+        """
+        columns = list(dict.fromkeys(col for _, df in frames for col in df.columns))
+
+        data = {}
+        for column in columns:
+            values = pd.concat(
+                [
+                    (
+                        df[column]
+                        if column in df.columns
+                        else pd.Series("", index=df.index, dtype="str")
+                    )
+                    for _, df in frames
+                ],
+                ignore_index=True,
+            ).fillna("")
+            data[column] = (
+                values.astype("category") if column in CATEGORICAL_COLUMNS else values
+            )
+
+        # Every row of a file belongs to its dropshipper, the ids stay integers
+        data["dropshipper_id"] = pd.Categorical(
+            np.concatenate(
+                [
+                    np.full(len(df), dropshipper_id, dtype=np.int64)
+                    for dropshipper_id, df in frames
+                ]
+            )
+        )
 
-        return self._parse(df)
+        return pd.DataFrame(data, copy=False)
 
     def standardize_columns(self, df):
         """This function standardizes the columns of the dataframe by renaming them to the standard names"""
 
-        for standard_name, variant_names in self.headder_maps.items():
-            for variant_name in variant_names:
-                if variant_name in df.columns:
-                    df.rename(columns={variant_name: standard_name}, inplace=True)
-                    break
+        columns = tuple(df.columns)
+        rename_plan = self._rename_plans.get(columns)
+        if rename_plan is None:
+            rename_plan = self._compile_rename_plan(columns)
+            self._rename_plans[columns] = rename_plan
+
+        if rename_plan:
+            df.rename(columns=rename_plan, inplace=True)
         return df
 
+    def _compile_rename_plan(self, columns):
+        """This function builds the renames for a header, using the highest priority variant of each normalized name"""
+
+        best_variants = {}
+        for column in columns:
+            if column not in self._header_index:
+                continue
+
+            standard_name, priority = self._header_index[column]
+            if (
+                standard_name not in best_variants
+                or priority < best_variants[standard_name][1]
+            ):
+                best_variants[standard_name] = (column, priority)
+
+        return {
+            column: standard_name
+            for standard_name, (column, _) in best_variants.items()
+        }
+
     def _transform_data(self, df):
         """This function transforms the data in the dataframe"""
 
-        # Transform city
-        df["city"] = df["city"].apply(self._text_formater)
+        # Transform city, the normalizer maps the categories and the result is made categorical again
+        df["city"] = self.normalizers["city"].apply(df["city"]).astype("category")
 
         # Zip code formatting
-        df["zip"] = df["zip"].apply(self._zip_formater)
+        df["zip"] = self.normalizers["zip"].apply(df["zip"])
 
         # Name formatting
-        df["customer_first_name"] = df["customer_first_name"].apply(lambda x: x.title())
-        df["customer_last_name"] = df["customer_last_name"].apply(lambda x: x.title())
+        df["customer_first_name"] = self.normalizers["name"].apply(
+            df["customer_first_name"]
+        )
+        df["customer_last_name"] = self.normalizers["name"].apply(
+            df["customer_last_name"]
+        )
 
         # Address concatenation
-        df["address"] = df.apply(
-            lambda row: (
-                row["address_1"] + " " + row["address_2"]
-                if "address_2" in row
-                else row["address_1"]
-            ),
-            axis=1,
-        )
+        if "address_2" in df.columns:
+            df["address"] = df["address_1"] + " " + df["address_2"]
+        else:
+            df["address"] = df["address_1"]
 
         # Country and State formatting
-        df[["country", "state"]] = df.apply(
-            lambda row: pd.Series(
-                self._country_and_state_formater(row["country"], row["state"])
-            ),
-            axis=1,
+        country_and_state = self.normalizers["country_and_state"].apply(
+            pd.Series(list(zip(df["country"], df["state"])), index=df.index)
         )
+        df["country"] = country_and_state.str[0].astype("category")
+        df["state"] = country_and_state.str[1].astype("category")
 
         # Phone number formatting
-        df["phone"] = df["phone"].apply(self._phone_formater)
+        df["phone"] = self.normalizers["phone"].apply(df["phone"])
 
         # Handling missing purchase order dates
         if "purchase_order_date" not in df.columns:
             df["purchase_order_date"] = ""
 
-        df["purchase_order_date"] = df["purchase_order_date"].apply(
-            lambda x: datetime.now().strftime("%Y-%m-%d %H:%M:%S") if x == "" else x
+        df["purchase_order_date"] = df["purchase_order_date"].mask(
+            df["purchase_order_date"] == "",
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         )
 
         # Convert quantity to integer
         df["quantity"] = df["quantity"].astype(int)
 
-        # Convert dropshipper ID to integer
-        df["dropshipper_id"] = df["dropshipper_id"].astype(int)
-
         return df
 
+    def normalization_stats(self):
+        """Returns the rows and distinct values formatted by each column normalizer"""
+
+        return {
+            name: normalizer.stats() for name, normalizer in self.normalizers.items()
+        }
+
     def _has_all_required_columns(self, row: pd.Series):
         """This function checks if the row has all the required columns"""
 
@@ -152,11 +306,12 @@ class XlsxParser:
         unparsed_skus = {}
         po_objs = {}
 
-        df = df.dropna(how="all").fillna("")
-
         df = self._transform_data(df)
+        # Categorical and string columns hold a missing value, like the None of an
+        # unknown country, as nan. The orders carry None so it is stored as NULL
+        df = df.astype(object).where(df.notna(), None)
 
-        for row in tqdm(df.itertuples(), desc="Parsing files"):
+        for row in progress(df.itertuples(), desc="Parsing files"):
             try:
                 sku = row.sku.replace(" ", "")
                 able_to_parse, missing_columns = self._has_all_required_columns(row)
@@ -300,20 +455,23 @@ class XlsxParser:
         else:
             return zip_code
 
-    def _df_reader(self, file_path):
-        """This function reads the file and returns a dataframe"""
+    def _df_reader(self, file_path, nrows=None):
+        """This function reads the file and returns a dataframe. Compressed files are decompressed on the fly"""
+        if inner_name(file_path).lower().endswith(EXCEL_EXTENSIONS):
+            return self._read_xlsx(file_path, nrows=nrows)
+
         try:
-            df = pd.read_csv(file_path, dtype=str, encoding="utf-8")
+            df = self._read_csv(file_path, encoding="utf-8", nrows=nrows)
 
         except UnicodeDecodeError:
             try:
-                df = pd.read_csv(
-                    file_path, dtype=str, encoding="ISO-8859-1"
+                df = self._read_csv(
+                    file_path, encoding="ISO-8859-1", nrows=nrows
                 )  # Trying with latin1 encoding
             except UnicodeDecodeError:
                 try:
-                    df = pd.read_csv(
-                        file_path, dtype=str, encoding="cp1252"
+                    df = self._read_csv(
+                        file_path, encoding="cp1252", nrows=nrows
                     )  # Trying with Windows encoding
                 except UnicodeDecodeError as e:
                     print(f"Error reading the file: {e}")
@@ -321,6 +479,80 @@ class XlsxParser:
 
         return df
 
+    def _read_csv(self, file_path, encoding, nrows=None):
+        """This function streams the csv, or the csv inside an archive, into a dataframe"""
+
+        with open_order_file(file_path) as stream:
+            return pd.read_csv(stream, dtype=str, encoding=encoding, nrows=nrows)
+
+    def _read_xlsx(self, file_path, nrows=None):
+        """This function reads the first sheet of a workbook chunk by chunk into a dataframe of strings, like the csv reader"""
+
+        with open_order_file(file_path) as stream:
+            # Read only mode loads the rows lazily instead of the whole workbook
+            workbook = openpyxl.load_workbook(stream, read_only=True, data_only=True)
+            try:
+                rows = workbook.worksheets[0].iter_rows(values_only=True)
+
+                header = list(next(rows, ()))
+                while header and header[-1] is None:
+                    header.pop()
+                columns = [
+                    f"Unnamed: {i}" if value is None else str(value).strip()
+                    for i, value in enumerate(header)
+                ]
+
+                chunks = []
+                chunk = []
+                read = 0
+                for row in rows:
+                    if nrows is not None and read >= nrows:
+                        break
+                    # Blank rows are skipped, as the csv reader does
+                    if all(value is None for value in row):
+                        continue
+                    values = [self._excel_cell_to_str(value) for value in row]
+                    values = values[: len(columns)]
+                    values += [None] * (len(columns) - len(values))
+                    chunk.append(values)
+                    read += 1
+
+                    # Full chunks are packed into string columns, so only one chunk
+                    # of rows is held as Python objects at a time
+                    if len(chunk) == XLSX_CHUNK_ROWS:
+                        chunks.append(self._rows_to_frame(chunk, columns))
+                        chunk = []
+
+                if chunk or not chunks:
+                    chunks.append(self._rows_to_frame(chunk, columns))
+
+            finally:
+                # Read only workbooks keep the archive open until closed
+                workbook.close()
+
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    def _rows_to_frame(self, rows, columns):
+        """This function packs rows of cell strings into a dataframe with the string dtype of the csv reader"""
+
+        return pd.DataFrame(rows, columns=columns, dtype=object).astype("str")
+
+    def _excel_cell_to_str(self, value):
+        """This function turns a cell value into the text the csv export would have"""
+
+        if value is None:
+            return None
+        if isinstance(value, bool):
+            return str(value).upper()
+        if isinstance(value, float) and value.is_integer():
+            # Order numbers and zips are stored as numbers by excel
+            return str(int(value))
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        return str(value)
+
     def data_extractor(self, path, po_header_name):
         try:
             file_name = path.split("\\")[-1]
@@ -328,6 +560,9 @@ class XlsxParser:
             pos = []
 
             df = self._df_reader(path)
+            # Removing whitespaces from the column names
+            df.columns = [col.replace(" ", "") for col in df.columns]
+            po_header_name = po_header_name.replace(" ", "")
             df = df[pd.notnull(df[po_header_name]) & (df[po_header_name] != "")]
             df[po_header_name] = df[po_header_name].astype(str)
             pos = df[po_header_name].tolist()